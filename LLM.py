@@ -1,19 +1,369 @@
+import asyncio
 import json
+import socket
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from urllib.parse import urlsplit, urlunsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from tools import TOOLS
+from metrics import registry
+from tracing import record_span
 from dotenv import load_dotenv
 
 load_dotenv()
 import os
 
-LLAMA_URL = os.getenv("LLAMA_URL")
+# Comma-separated llama-server chat URLs; defaults to the single LLAMA_URL
+LLAMA_URLS = [
+    url.strip()
+    for url in os.getenv("LLAMA_URLS", os.getenv("LLAMA_URL") or "").split(",")
+    if url.strip()
+]
+LLAMA_URL = LLAMA_URLS[0] if LLAMA_URLS else None
+LLAMA_POOL_SIZE = int(os.getenv("LLAMA_POOL_SIZE", 10))
+LLAMA_CONNECT_TIMEOUT = float(os.getenv("LLAMA_CONNECT_TIMEOUT", 5))
+LLAMA_READ_TIMEOUT = float(os.getenv("LLAMA_READ_TIMEOUT", 300))
+# Forward upstream content/timings chunks to the client verbatim
+LLAMA_SSE_PASSTHROUGH = os.getenv("LLAMA_SSE_PASSTHROUGH", "0") == "1"
+# Number of llama-server slots (--parallel); unset asks the server's /slots
+LLAMA_SLOTS = os.getenv("LLAMA_SLOTS")
+# Seconds between backend health probes; 0 disables them
+LLAMA_HEALTH_INTERVAL = float(os.getenv("LLAMA_HEALTH_INTERVAL", 10))
+
+
+# --------------------
+# CONNECTION POOL
+# --------------------
+# One keep-alive session shared by all request threads. LLAMA_POOL_SIZE caps
+# the idle connections kept per host; the read timeout applies between
+# streamed chunks, not to the whole response.
+llama_adapter = HTTPAdapter(
+    pool_connections=max(len(LLAMA_URLS), 1), pool_maxsize=LLAMA_POOL_SIZE
+)
+llama_session = requests.Session()
+llama_session.mount("http://", llama_adapter)
+llama_session.mount("https://", llama_adapter)
+
+# Connections used by the request the current thread is sending, if it
+# wants them recorded (see llama_chat_stream)
+request_local = threading.local()
+
+
+class RecordedConnectionMixin:
+    """Records the connection a request goes out on, so it can be aborted."""
+
+    def getresponse(self, *args, **kwargs):
+        connections = getattr(request_local, "connections", None)
+        if connections is not None:
+            connections.append(self)
+        return super().getresponse(*args, **kwargs)
+
+
+class RecordedHTTPConnection(RecordedConnectionMixin, HTTPConnection):
+    pass
+
+
+class RecordedHTTPSConnection(RecordedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class RecordedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = RecordedHTTPConnection
+
+
+class RecordedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = RecordedHTTPSConnection
+
+
+llama_adapter.poolmanager.pool_classes_by_scheme = {
+    "http": RecordedHTTPConnectionPool,
+    "https": RecordedHTTPSConnectionPool,
+}
+
+
+def abort(connections):
+    """Shut down connections, waking any thread blocked reading from them."""
+    for conn in connections:
+        sock = conn.sock
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed
+
+
+def get_pool_stats():
+    """Get connection statistics for the llama-server pools.
+
+    The top-level counts are for the requests session that generations on
+    threads use (under a WSGI server); "async" has those of the httpx
+    client that generations on the event loop use under asgi.py.
+    """
+    opened = requests_sent = idle = active = 0
+    for key in llama_adapter.poolmanager.pools.keys():
+        pool = llama_adapter.poolmanager.pools.get(key)
+        if pool is None or pool.pool is None:
+            continue
+        opened += pool.num_connections
+        requests_sent += pool.num_requests
+        idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        active += pool.pool.maxsize - pool.pool.qsize()
+    return {
+        "pool_size": LLAMA_POOL_SIZE,
+        "connections_opened": opened,
+        "idle_connections": idle,
+        "active_connections": active,
+        "requests": requests_sent,
+        "reuse_rate": 1 - opened / requests_sent if requests_sent else 0.0,
+        "async": get_async_pool_stats(),
+        "backends": llama_backends.stats(),
+    }
+
+
+# --------------------
+# KV CACHE AFFINITY
+# --------------------
+def server_url(path, chat_url=None):
+    """Build a llama-server URL (e.g. /slots) from its chat completions URL."""
+    parts = urlsplit(chat_url or LLAMA_URL)
+    return urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+
+
+class SlotAffinity:
+    """Pins chats to llama-server slots so follow-up prompts hit the KV cache.
+
+    Each chat keeps its slot while it stays among the most recently used.
+    A new chat takes a free slot, else the least recently used slot that has
+    no request in flight, else the least recently used slot.
+    """
+
+    def __init__(self, num_slots=None, chat_url=None):
+        self.num_slots = num_slots
+        self.chat_url = chat_url
+        self._assignments = OrderedDict()  # chat key -> slot, LRU first
+        self._busy = {}  # slot -> requests in flight
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Get the slot for a chat key and mark it busy (None if unknown)."""
+        if self.num_slots is None:
+            self.resize(self.detect_slots())
+        if not self.num_slots or key is None:
+            return None
+
+        with self._lock:
+            slot = self._assignments.get(key)
+            if slot is None:
+                used = set(self._assignments.values())
+                free = [s for s in range(self.num_slots) if s not in used]
+                if free:
+                    slot = free[0]
+                else:
+                    idle = [
+                        k for k, s in self._assignments.items() if not self._busy.get(s)
+                    ]
+                    victim = idle[0] if idle else next(iter(self._assignments))
+                    slot = self._assignments.pop(victim)
+                self._assignments[key] = slot
+            self._assignments.move_to_end(key)
+            self._busy[slot] = self._busy.get(slot, 0) + 1
+            return slot
+
+    def release(self, slot):
+        if slot is None:
+            return
+        with self._lock:
+            self._busy[slot] -= 1
+
+    def resize(self, num_slots):
+        """Change the slot count, dropping assignments to removed slots."""
+        with self._lock:
+            self.num_slots = num_slots
+            for key, slot in list(self._assignments.items()):
+                if slot >= num_slots:
+                    del self._assignments[key]
+
+    def detect_slots(self):
+        try:
+            resp = llama_session.get(
+                server_url("/slots", self.chat_url),
+                timeout=(LLAMA_CONNECT_TIMEOUT, 10),
+            )
+            resp.raise_for_status()
+            return len(resp.json())
+        except (requests.RequestException, ValueError, TypeError):
+            # /slots may be disabled; fall back to prompt caching without pinning
+            return 0
+
+
+class PromptCacheStats:
+    """Totals of prompt tokens served from the KV cache vs. evaluated."""
+
+    def __init__(self):
+        self.requests = 0
+        self.cached_tokens = 0
+        self.evaluated_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, timings):
+        with self._lock:
+            self.requests += 1
+            self.cached_tokens += timings.get("cache_n", 0)
+            self.evaluated_tokens += timings.get("prompt_n", 0)
+
+    def stats(self):
+        with self._lock:
+            total = self.cached_tokens + self.evaluated_tokens
+            return {
+                "requests": self.requests,
+                "cached_tokens": self.cached_tokens,
+                "evaluated_tokens": self.evaluated_tokens,
+                "cached_ratio": self.cached_tokens / total if total else 0.0,
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
+
+time_to_first_token = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "Seconds from sending a request to llama-server until its first chunk",
+)
+generation_speed = registry.histogram(
+    "llm_generation_tokens_per_second",
+    "Generation speed reported in llama-server timings",
+    buckets=(1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 250),
+)
+prompt_tokens = registry.histogram(
+    "llm_prompt_tokens",
+    "Prompt size in tokens (cached and evaluated) reported in timings",
+    buckets=(128, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072),
+)
+
+
+# --------------------
+# BACKEND POOL
+# --------------------
+class Backend:
+    """One llama-server, with its slot assignments and request counters."""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.slots = SlotAffinity(int(LLAMA_SLOTS) if LLAMA_SLOTS else None, url)
+
+    def probe(self):
+        """Check /health (and refresh the slot count) and update healthy."""
+        try:
+            resp = llama_session.get(
+                server_url("/health", self.url),
+                timeout=(LLAMA_CONNECT_TIMEOUT, 10),
+            )
+            # llama-server answers 503 while the model is still loading
+            self.healthy = resp.ok
+        except requests.RequestException:
+            self.healthy = False
+        if self.healthy and not LLAMA_SLOTS:
+            self.slots.resize(self.slots.detect_slots())
+
+
+class BackendPool:
+    """Routes chats across llama-servers.
+
+    A chat sticks to the backend that served it last so its KV cache can be
+    reused. New chats, and chats whose backend is down, go to the healthy
+    backend with the fewest requests in flight. A background thread probes
+    every backend so failed ones rejoin once they recover.
+    """
+
+    def __init__(self, urls, health_interval, max_sticky=10000):
+        self.backends = [Backend(url) for url in urls]
+        self.health_interval = health_interval
+        self.max_sticky = max_sticky
+        self._sticky = OrderedDict()  # chat key -> backend, LRU first
+        self._lock = threading.Lock()
+        self._monitor = None
+
+    def acquire(self, key, exclude=()):
+        """Pick a backend for a chat key and count a request in flight.
+
+        Returns None when every backend has been excluded.
+        """
+        self._start_monitor()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            healthy = [b for b in candidates if b.healthy] or candidates
+            backend = self._sticky.get(key)
+            if backend not in healthy:
+                backend = min(healthy, key=lambda b: b.outstanding)
+            if key is not None:
+                self._sticky[key] = backend
+                self._sticky.move_to_end(key)
+                if len(self._sticky) > self.max_sticky:
+                    self._sticky.popitem(last=False)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+
+    def mark_failed(self, backend):
+        """Take a backend out of rotation until the next successful probe."""
+        with self._lock:
+            backend.healthy = False
+            backend.failures += 1
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "url": backend.url,
+                    "healthy": backend.healthy,
+                    "outstanding": backend.outstanding,
+                    "requests": backend.requests,
+                    "failures": backend.failures,
+                    "slots": backend.slots.num_slots,
+                }
+                for backend in self.backends
+            ]
+
+    def _start_monitor(self):
+        if self._monitor is not None or not self.health_interval:
+            return
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(
+                    target=self._monitor_loop, name="llama-health", daemon=True
+                )
+                self._monitor.start()
+
+    def _monitor_loop(self):
+        while True:
+            for backend in self.backends:
+                backend.probe()
+            time.sleep(self.health_interval)
+
+
+llama_backends = BackendPool(LLAMA_URLS, LLAMA_HEALTH_INTERVAL)
 
 
 # --------------------
 # MODEL CALL
 # --------------------
-def llama_chat_stream(messages, enabled_tools):
-    """Send chat messages to the llama-server and stream the response."""
+def chat_payload(messages, enabled_tools):
+    """Build the streaming chat completion request for llama-server."""
     # Filter tools based on enabled_tools
     available_tools = [
         tool["schema"]
@@ -22,61 +372,377 @@ def llama_chat_stream(messages, enabled_tools):
     ]
     print(messages)
 
-    payload = {
+    return {
         "messages": messages,
         "tools": available_tools,
         "stream": True,
         "timings_per_token": True,
+        "cache_prompt": True,
     }
 
-    resp = requests.post(
-        LLAMA_URL,
-        headers={"Content-Type": "application/json"},
-        data=json.dumps(payload),
-        stream=True,
-    )
-    resp.raise_for_status()
 
-    content = ""
-    reasoning_content = ""
-    tool_calls = {}
-    final_data = None
+def llama_chat_stream(
+    messages,
+    enabled_tools,
+    passthrough=LLAMA_SSE_PASSTHROUGH,
+    cache_key=None,
+    cancel=None,
+):
+    """Send chat messages to the llama-server and stream the response.
+
+    Yields event dicts ("timings", "content", "reasoning_content" and a final
+    "complete" carrying the assembled message). With passthrough, the first
+    three are instead yielded as the upstream chunk's raw JSON string, which
+    the client decodes itself; callers must send strings on unchanged.
+    Requests with the same cache_key (e.g. a chat id) are pinned to the same
+    server and slot so their shared prompt prefix stays cached. If a server
+    fails before anything has been yielded, the request moves to another one.
+    Setting the cancel event (a jobs.CancelEvent) shuts the upstream
+    connection down at once, which frees the server slot even during
+    prefill. The "complete" event then carries the partial message with
+    stopped set; it is left out if nothing had arrived yet.
+    """
+    payload = chat_payload(messages, enabled_tools)
+
+    tried = []
+    error = requests.ConnectionError("No llama-server configured (set LLAMA_URL)")
+    while True:
+        backend = llama_backends.acquire(cache_key, exclude=tried)
+        if backend is None:
+            raise error
+        slot = backend.slots.acquire(cache_key)
+        payload.pop("id_slot", None)
+        if slot is not None:
+            payload["id_slot"] = slot
+
+        started = False
+        sent_at = time.perf_counter()
+        # Shut the connection down the moment a stop comes in, even while
+        # llama-server is still processing the prompt
+        connections = []
+        unregister = (
+            cancel.add_callback(partial(abort, connections)) if cancel else None
+        )
+        try:
+            request_local.connections = connections
+            try:
+                resp = llama_session.post(
+                    backend.url,
+                    headers={"Content-Type": "application/json"},
+                    data=json.dumps(payload),
+                    stream=True,
+                    timeout=(LLAMA_CONNECT_TIMEOUT, LLAMA_READ_TIMEOUT),
+                )
+            finally:
+                request_local.connections = None
+            with resp:
+                resp.raise_for_status()
+                for event in parse_chat_stream(resp, passthrough, cancel, sent_at):
+                    started = True
+                    yield event
+            return
+        except requests.RequestException as e:
+            if cancel is not None and cancel.is_set():
+                return
+            # Client errors (e.g. prompt too long) would fail anywhere
+            status = e.response.status_code if e.response is not None else 500
+            if started or status < 500:
+                raise
+            llama_backends.mark_failed(backend)
+            tried.append(backend)
+            error = e
+        finally:
+            if unregister:
+                unregister()
+            backend.slots.release(slot)
+            llama_backends.release(backend)
+
+
+# --------------------
+# ASYNC MODEL CALL
+# --------------------
+# (event loop, httpx.AsyncClient) used by allama_chat_stream
+_async_client = None
+# Connections opened and requests sent by that client, for get_pool_stats
+async_pool_counts = {"connections_opened": 0, "requests": 0}
+
+
+async def count_connection(event_name, info):
+    """httpx trace hook counting the connections the client opens."""
+    if event_name == "connection.connect_tcp.complete":
+        async_pool_counts["connections_opened"] += 1
+
+
+def get_async_pool_stats():
+    """Get connection statistics for the async llama-server client."""
+    idle = active = 0
+    if _async_client is not None:
+        # httpx has no public view of its connection pool
+        for conn in _async_client[1]._transport._pool.connections:
+            if conn.is_idle():
+                idle += 1
+            elif not conn.is_closed():
+                active += 1
+    opened = async_pool_counts["connections_opened"]
+    requests_sent = async_pool_counts["requests"]
+    return {
+        "connections_opened": opened,
+        "idle_connections": idle,
+        "active_connections": active,
+        "requests": requests_sent,
+        "reuse_rate": 1 - opened / requests_sent if requests_sent else 0.0,
+    }
+
+
+def async_llama_client():
+    """Get the keep-alive httpx client for the running event loop.
+
+    httpx is only needed by the ASGI entry point, so it is imported here.
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop:
+        import httpx
+
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(LLAMA_READ_TIMEOUT, connect=LLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=None, max_keepalive_connections=LLAMA_POOL_SIZE
+            ),
+        )
+        _async_client = (loop, client)
+    return _async_client[1]
+
+
+async def close_async_llama_client():
+    """Close the running event loop's httpx client, if it has one."""
+    global _async_client
+    if _async_client is not None and _async_client[0] is asyncio.get_running_loop():
+        client = _async_client[1]
+        _async_client = None
+        await client.aclose()
+
+
+async def allama_chat_stream(
+    messages,
+    enabled_tools,
+    passthrough=LLAMA_SSE_PASSTHROUGH,
+    cache_key=None,
+    cancel=None,
+):
+    """Like llama_chat_stream, but for a coroutine: no thread is blocked.
+
+    The upstream response is read by a task of its own; setting cancel
+    cancels that task, which closes the connection at once, even during
+    prefill.
+    """
+    import httpx
 
-    for line in resp.iter_lines(decode_unicode=True):
+    payload = chat_payload(messages, enabled_tools)
+    client = async_llama_client()
+    loop = asyncio.get_running_loop()
+
+    tried = []
+    error = requests.ConnectionError("No llama-server configured (set LLAMA_URL)")
+    while True:
+        backend = llama_backends.acquire(cache_key, exclude=tried)
+        if backend is None:
+            raise error
+        if backend.slots.num_slots is None:
+            # Asking the server for its slot count blocks; keep it off the loop
+            slot = await asyncio.to_thread(backend.slots.acquire, cache_key)
+        else:
+            slot = backend.slots.acquire(cache_key)
+        payload.pop("id_slot", None)
+        if slot is not None:
+            payload["id_slot"] = slot
+
+        started = False
+        parser = ChatStreamParser(passthrough, time.perf_counter())
+        lines = asyncio.Queue()
+        reader = asyncio.ensure_future(
+            read_upstream(client, backend.url, payload, lines)
+        )
+        unregister = (
+            cancel.add_callback(lambda: loop.call_soon_threadsafe(reader.cancel))
+            if cancel
+            else None
+        )
+        try:
+            while True:
+                kind, item = await lines.get()
+                if kind == "error":
+                    raise item
+                if kind == "done" or (cancel is not None and cancel.is_set()):
+                    break
+                for event in parser.feed(item):
+                    started = True
+                    yield event
+                if parser.ended:
+                    # Read to the end of the response, so the connection
+                    # goes back to the pool instead of being dropped
+                    while kind != "done" and not (cancel and cancel.is_set()):
+                        kind, item = await lines.get()
+                    break
+            if not parser.ended and cancel is not None and cancel.is_set():
+                parser.stopped = True
+            for event in parser.finish():
+                yield event
+            return
+        except httpx.HTTPError as e:
+            if cancel is not None and cancel.is_set():
+                return
+            # Client errors (e.g. prompt too long) would fail anywhere
+            status = (
+                e.response.status_code if isinstance(e, httpx.HTTPStatusError) else 500
+            )
+            if started or status < 500:
+                raise
+            llama_backends.mark_failed(backend)
+            tried.append(backend)
+            error = e
+        finally:
+            reader.cancel()
+            if unregister:
+                unregister()
+            backend.slots.release(slot)
+            llama_backends.release(backend)
+
+
+async def read_upstream(client, url, payload, lines):
+    """Put a streamed llama-server response's lines on an asyncio queue.
+
+    Queues ("line", text) items, ("error", exception) if the request
+    failed, and always ("done", None) last.
+    """
+    async_pool_counts["requests"] += 1
+    try:
+        async with client.stream(
+            "POST",
+            url,
+            headers={"Content-Type": "application/json"},
+            content=json.dumps(payload),
+            extensions={"trace": count_connection},
+        ) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                lines.put_nowait(("line", line))
+    except Exception as e:
+        lines.put_nowait(("error", e))
+    finally:
+        lines.put_nowait(("done", None))
+
+
+def read_lines(resp, cancel=None):
+    """Iterate a streamed response's lines until it ends or cancel is set.
+
+    Stopping shuts the connection down from another thread, which makes the
+    read in progress fail; that ends the lines instead of raising.
+    """
+    lines = resp.iter_lines(decode_unicode=True)
+    while True:
+        try:
+            line = next(lines)
+        except StopIteration:
+            return
+        except Exception:
+            if cancel is not None and cancel.is_set():
+                return
+            raise
+        yield line
+
+
+def parse_chat_stream(resp, passthrough=False, cancel=None, sent_at=None):
+    """Turn a llama-server SSE response into UI events and a final message.
+
+    sent_at is when the request was sent, for the time-to-first-token metric
+    and the "prefill" and "decode" trace spans.
+    """
+    parser = ChatStreamParser(passthrough, sent_at)
+    for line in read_lines(resp, cancel):
+        if cancel is not None and cancel.is_set():
+            parser.stopped = True
+            break
+        yield from parser.feed(line)
+        if parser.ended:
+            break
+    if not parser.ended and cancel is not None and cancel.is_set():
+        parser.stopped = True
+    yield from parser.finish()
+
+
+class ChatStreamParser:
+    """Assembles llama-server SSE lines into UI events and a final message.
+
+    feed() takes one line at a time and returns the events it produces;
+    finish() returns the closing "complete" event. Set stopped first if the
+    stream was cut short on purpose. Shared by the blocking and async
+    clients.
+    """
+
+    def __init__(self, passthrough=False, sent_at=None):
+        self.passthrough = passthrough
+        self.sent_at = sent_at
+        self.content = ""
+        self.reasoning_content = ""
+        self.tool_calls = {}
+        self.final_data = None
+        self.timings = None
+        self.stopped = False
+        self.ended = False
+        self.first_chunk_at = None
+
+    def feed(self, line):
+        events = []
         if not line or not line.startswith("data: "):
-            continue
+            return events
         if line.strip() == "data: [DONE]":
-            break
+            self.ended = True
+            return events
 
         try:
             chunk = json.loads(line[6:])
             if len(chunk["choices"]) == 0:
-                break
-
-            final_data = chunk
-
-            if "timings" in chunk:
-                yield json.dumps({"type": "timings", "timings": chunk["timings"]})
+                self.ended = True
+                return events
 
+            if self.final_data is None and self.sent_at is not None:
+                self.first_chunk_at = time.perf_counter()
+                time_to_first_token.observe(self.first_chunk_at - self.sent_at)
+            self.final_data = chunk
+            self.timings = chunk.get("timings", self.timings)
             delta = chunk["choices"][0].get("delta", {})
 
-            if "content" in delta and delta["content"]:
-                yield json.dumps({"type": "content", "content": delta["content"]})
-                content += delta["content"]
+            if self.passthrough:
+                if (
+                    "timings" in chunk
+                    or delta.get("content")
+                    or delta.get("reasoning_content")
+                ):
+                    events.append(line[6:])
+                self.content += delta.get("content") or ""
+                self.reasoning_content += delta.get("reasoning_content") or ""
+            else:
+                if "timings" in chunk:
+                    events.append({"type": "timings", "timings": chunk["timings"]})
 
-            if "reasoning_content" in delta and delta.get("reasoning_content"):
-                yield json.dumps(
-                    {
-                        "type": "reasoning_content",
-                        "content": delta["reasoning_content"],
-                    }
-                )
-                reasoning_content += delta["reasoning_content"]
+                if "content" in delta and delta["content"]:
+                    events.append({"type": "content", "content": delta["content"]})
+                    self.content += delta["content"]
+
+                if "reasoning_content" in delta and delta.get("reasoning_content"):
+                    events.append(
+                        {
+                            "type": "reasoning_content",
+                            "content": delta["reasoning_content"],
+                        }
+                    )
+                    self.reasoning_content += delta["reasoning_content"]
 
             if "tool_calls" in delta:
                 for tc in delta["tool_calls"]:
                     idx = tc["index"]
-                    existing = tool_calls.get(
+                    existing = self.tool_calls.get(
                         idx,
                         {
                             "id": tc.get("id"),
@@ -92,17 +758,39 @@ def llama_chat_stream(messages, enabled_tools):
                         existing["id"] = tc["id"]
                     if "type" in tc:
                         existing["type"] = tc["type"]
-                    tool_calls[idx] = existing
+                    self.tool_calls[idx] = existing
 
         except (json.JSONDecodeError, KeyError):
-            continue
+            pass
+        return events
+
+    def finish(self):
+        """Record the stream's metrics and get its "complete" event, if any."""
+        if self.first_chunk_at is not None:
+            record_span("prefill", self.sent_at, self.first_chunk_at)
+            record_span(
+                "decode",
+                self.first_chunk_at,
+                time.perf_counter(),
+                stopped=self.stopped,
+            )
+
+        timings = self.timings
+        if timings:
+            prompt_cache_stats.record(timings)
+            prompt_tokens.observe(
+                timings.get("prompt_n", 0) + timings.get("cache_n", 0)
+            )
+            if timings.get("predicted_per_second"):
+                generation_speed.observe(timings["predicted_per_second"])
 
-    if final_data:
+        if not self.final_data:
+            return []
         message = {
             "role": "assistant",
-            "content": content,
-            "reasoning_content": reasoning_content,
+            "content": self.content,
+            "reasoning_content": self.reasoning_content,
         }
-        if tool_calls:
-            message["tool_calls"] = list(tool_calls.values())
-        yield json.dumps({"type": "complete", "message": message})
+        if self.tool_calls and not self.stopped:
+            message["tool_calls"] = list(self.tool_calls.values())
+        return [{"type": "complete", "message": message, "stopped": self.stopped}]
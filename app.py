@@ -1,8 +1,22 @@
+import asyncio
+import atexit
+import contextvars
+import hmac
 import json
+import signal
 import uuid
 import os
 import base64
 import mimetypes
+import mmap
+import queue
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from itertools import count
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from dataclasses import dataclass, field
 from typing import List, Dict, Optional, Any
@@ -16,12 +30,24 @@ from flask import (
     redirect,
     url_for,
     flash,
+    g,
 )
-import pickle
 from werkzeug.utils import secure_filename
-from tools import TOOLS
-from LLM import llama_chat_stream
-from functools import wraps
+from tools import TOOLS, tool_cache
+from LLM import (
+    llama_chat_stream,
+    allama_chat_stream,
+    get_pool_stats,
+    prompt_cache_stats,
+)
+from storage import ChatStore, WriteBehind
+from cache import LRUCache
+from context import context_builder
+from scheduler import scheduler, QueueTimeout
+from jobs import generation_jobs
+from metrics import registry
+from tracing import trace, span, record_span, current_trace, traces, TRACE_DEBUG
+from functools import partial, wraps
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -35,6 +61,29 @@ app.config["MAX_CONTENT_LENGTH"] = int(
     os.getenv("MAX_CONTENT_LENGTH", 16 * 1024 * 1024)
 )
 LLAMA_URL = os.getenv("LLAMA_URL")
+CHATS_DB = os.getenv("CHATS_DB", "chats.db")
+LEGACY_CHATS_FILE = "chats.pkl"
+# Saves are batched and written this long after the first one; 0 writes
+# synchronously. This bounds how much is lost if the process dies.
+PERSIST_DELAY = float(os.getenv("PERSIST_DELAY", 0.5))
+# Worker processes sharing CHATS_DB; above 1, writes go straight to the
+# database and each request picks up changes made by the other workers
+APP_WORKERS = int(os.getenv("APP_WORKERS", 1))
+# Budget for chat trees kept in memory; colder trees are reloaded on access
+MAX_LOADED_CHATS = int(os.getenv("MAX_LOADED_CHATS", 64))
+MAX_LOADED_NODES = int(os.getenv("MAX_LOADED_NODES", 20000))
+IMAGE_CACHE_BYTES = int(os.getenv("IMAGE_CACHE_BYTES", 64 * 1024 * 1024))
+TEXT_CACHE_BYTES = int(os.getenv("TEXT_CACHE_BYTES", 32 * 1024 * 1024))
+# Text files at least this large are memory-mapped instead of read
+MMAP_THRESHOLD = int(os.getenv("MMAP_THRESHOLD", 1024 * 1024))
+TOOL_WORKERS = int(os.getenv("TOOL_WORKERS", 8))
+# Default per-call timeout for tools that don't define their own
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", 30))
+# Streamed deltas are batched for up to this long / this many characters
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", 50))
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", 512))
+# Bearer token that lets scrapers read /metrics without logging in
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 # Ensure upload directory exists
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
@@ -66,15 +115,36 @@ class ChatNode:
     created_at: datetime = field(default_factory=datetime.now)
     tool_calls: Optional[List[Dict]] = None
     tool_results: Optional[List[Dict]] = None
+    parent: Optional["ChatNode"] = field(default=None, repr=False, compare=False)
 
     def to_dict(self):
+        data = self.to_record()
+        data["children"] = [child.to_dict() for child in self.children]
+        return data
+
+    def to_view(self, depth: int = 0):
+        """Serialize this node for the UI with branch counts.
+
+        Children are included down to the given depth; deeper levels are only
+        reflected in child_count.
+        """
+        data = self.to_record()
+        siblings = self.parent.children if self.parent else [self]
+        data["sibling_count"] = len(siblings)
+        data["sibling_index"] = siblings.index(self)
+        data["child_count"] = len(self.children)
+        if depth > 0:
+            data["children"] = [child.to_view(depth - 1) for child in self.children]
+        return data
+
+    def to_record(self):
+        """Serialize this node without its children."""
         return {
             "id": self.id,
             "role": self.role,
             "content": self.content,
             "message": self.message,
             "files": self.files,
-            "children": [child.to_dict() for child in self.children],
             "parent_id": self.parent_id,
             "created_at": self.created_at.isoformat(),
             "tool_calls": self.tool_calls,
@@ -107,6 +177,44 @@ class ChatTree:
     root: ChatNode
     current_node_id: str
     files: Dict[str, Dict[str, Any]] = field(default_factory=dict)  # uuid -> file info
+    nodes: Dict[str, ChatNode] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )  # id -> node
+
+    def __post_init__(self):
+        self.reindex()
+
+    def reindex(self):
+        """Rebuild the id -> node index and parent pointers from the root."""
+        self.nodes = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            self.nodes[node.id] = node
+            for child in node.children:
+                child.parent = node
+                stack.append(child)
+
+    def get_node(self, node_id: str) -> Optional[ChatNode]:
+        """Look up a node by its ID."""
+        return self.nodes.get(node_id)
+
+    def add_child(self, parent: ChatNode, child: ChatNode):
+        """Append a child node and register it in the index."""
+        child.parent = parent
+        child.parent_id = parent.id
+        parent.children.append(child)
+        self.nodes[child.id] = child
+
+    def path_to(self, node_id: str) -> List[ChatNode]:
+        """Get the nodes from the root to the specified node (inclusive)."""
+        path = []
+        current = self.nodes.get(node_id)
+        while current:
+            path.append(current)
+            current = current.parent
+        path.reverse()
+        return path
 
     def to_dict(self):
         return {
@@ -129,9 +237,15 @@ class ChatTree:
 class Chat:
     id: str
     title: str
-    tree: ChatTree
+    tree: Optional[ChatTree] = None  # None until hydrated by get_chat
     created_at: datetime = field(default_factory=datetime.now)
     updated_at: datetime = field(default_factory=datetime.now)
+    pins: int = field(default=0, repr=False, compare=False)
+    version: int = field(default=0, repr=False, compare=False)
+    # Store revision this process last saw, and whether another worker has
+    # changed the chat since (its tree is then reloaded on next access)
+    rev: int = field(default=0, repr=False, compare=False)
+    stale: bool = field(default=False, repr=False, compare=False)
 
     def to_dict(self):
         return {
@@ -142,6 +256,17 @@ class Chat:
             "updated_at": self.updated_at.isoformat(),
         }
 
+    def to_record(self):
+        """Serialize the chat's metadata without its nodes."""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
+            "current_node_id": self.tree.current_node_id,
+            "files": self.tree.files,
+        }
+
     @classmethod
     def from_dict(cls, data):
         chat = cls(
@@ -153,37 +278,205 @@ class Chat:
         )
         return chat
 
+    @classmethod
+    def from_record(cls, data):
+        """Create a chat from its metadata record, leaving the tree unloaded."""
+        return cls(
+            id=data["id"],
+            title=data["title"],
+            created_at=datetime.fromisoformat(data["created_at"]),
+            updated_at=datetime.fromisoformat(data["updated_at"]),
+            rev=data.get("rev", 0),
+        )
+
+
+class ChatIndex:
+    """Chat listing entries kept sorted by updated_at for the sidebar."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # (updated_at, chat_id), oldest first
+        self._entries = {}  # chat_id -> (key, listing entry)
+
+    def rebuild(self, chats: List[Chat]):
+        with self._lock:
+            self._entries = {chat.id: self._make_entry(chat) for chat in chats}
+            self._keys = sorted(key for key, _ in self._entries.values())
+
+    def update(self, chat: Chat):
+        """Insert or refresh a chat's entry after its title or timestamp changed."""
+        with self._lock:
+            self._discard(chat.id)
+            self._entries[chat.id] = self._make_entry(chat)
+            insort(self._keys, self._entries[chat.id][0])
+
+    def remove(self, chat_id: str):
+        with self._lock:
+            self._discard(chat_id)
+
+    def page(
+        self,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        query: str = "",
+    ):
+        """Get entries newest first, starting after cursor and matching query.
+
+        Returns the entries and the cursor for the next page (None if done).
+        """
+        query = query.lower()
+        with self._lock:
+            start = len(self._keys)
+            if cursor:
+                updated_at, _, chat_id = cursor.partition("|")
+                start = bisect_left(
+                    self._keys, (datetime.fromisoformat(updated_at), chat_id)
+                )
+
+            entries = []
+            for i in range(start - 1, -1, -1):
+                key = self._keys[i]
+                entry = self._entries[key[1]][1]
+                if query and query not in entry["title"].lower():
+                    continue
+                if limit is not None and len(entries) == limit:
+                    last = entries[-1]
+                    return entries, f"{last['updated_at']}|{last['id']}"
+                entries.append(entry)
+        return entries, None
+
+    def _discard(self, chat_id: str):
+        old = self._entries.pop(chat_id, None)
+        if old:
+            i = bisect_left(self._keys, old[0])
+            if i < len(self._keys) and self._keys[i] == old[0]:
+                del self._keys[i]
+
+    @staticmethod
+    def _make_entry(chat: Chat):
+        entry = {
+            "id": chat.id,
+            "title": chat.title,
+            "created_at": chat.created_at.isoformat(),
+            "updated_at": chat.updated_at.isoformat(),
+        }
+        return (chat.updated_at, chat.id), entry
+
+
+# Versions for conditional GETs. Every mutation takes the next number from one
+# counter; BOOT_ID keeps ETags from a previous process from matching.
+BOOT_ID = uuid.uuid4().hex[:8]
+version_counter = count(1)
+chats_version = 0  # bumped when the chat listing changes
+files_version = 0  # bumped when a file is uploaded
 
 # Global chats storage
+store = ChatStore(CHATS_DB)
+writer = WriteBehind(store, PERSIST_DELAY if APP_WORKERS <= 1 else 0)
+atexit.register(writer.close)
 chats: Dict[str, Chat] = {}
+chats_lock = threading.Lock()
+# Chat id -> lock serializing changes to that chat's tree
+chat_locks: Dict[str, threading.RLock] = {}
+chat_index = ChatIndex()
+# Ids of chats whose trees are in memory, least recently used first
+loaded_chats: "OrderedDict[str, None]" = OrderedDict()
 global_files: Dict[str, Dict[str, Any]] = {}  # Global files shared across chats
+# Store sequence number of the last write this process has synced
+synced_seq = 0
 
 # Tool configuration
 enabled_tools = {"calculator": True, "web_search": True, "read_url": True}
 
+# Encoded image data URLs and text file contents keyed by (file uuid, mtime)
+image_cache = LRUCache(IMAGE_CACHE_BYTES)
+text_cache = LRUCache(TEXT_CACHE_BYTES, sizeof=sys.getsizeof)
+
+# Shared pool for running tool handlers
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+# Chat id -> stop events of the chat's running generations
+active_generations: Dict[str, set] = {}
+
+# Metrics served at /metrics
+tool_seconds = registry.histogram(
+    "tool_duration_seconds", "Seconds spent in a tool handler", labelnames=("tool",)
+)
+tool_errors = registry.counter(
+    "tool_errors_total", "Tool calls that failed or timed out", labelnames=("tool",)
+)
+storage_seconds = registry.histogram(
+    "storage_duration_seconds",
+    "Seconds spent writing or loading chats",
+    labelnames=("operation",),
+)
+# Saves are only queued; time the batches the writer commits
+writer.on_flush = lambda seconds: storage_seconds.observe(
+    seconds, operation="write_batch"
+)
+prompt_build_seconds = registry.histogram(
+    "prompt_build_seconds", "Seconds spent assembling and fitting a prompt"
+)
+registry.gauge(
+    "generation_jobs_running",
+    "Generations in progress",
+    lambda: generation_jobs.stats()["running"],
+)
+registry.gauge(
+    "generation_stream_viewers",
+    "Open response streams following a generation",
+    lambda: generation_jobs.stats()["viewers"],
+)
+registry.gauge(
+    "scheduler_waiting",
+    "Generations waiting for a free slot",
+    lambda: scheduler.stats()["waiting"],
+)
+registry.gauge(
+    "persistence_pending",
+    "Chat saves queued but not yet written",
+    lambda: writer.stats()["pending"],
+)
+registry.gauge(
+    "cache_hit_ratio",
+    "Hits over lookups for each cache since startup",
+    lambda: {
+        "images": image_cache.stats()["hit_rate"],
+        "text_files": text_cache.stats()["hit_rate"],
+        "token_counts": context_builder.counter.cache.stats()["hit_rate"],
+        "prompt": prompt_cache_stats.stats()["cached_ratio"],
+        **{
+            "tool_" + tool: counts["hit_rate"]
+            for tool, counts in tool_cache.stats()["tools"].items()
+        },
+    },
+    labelnames=("cache",),
+)
+
 
 # --------------------
 # UTILITY FUNCTIONS
 # --------------------
 
 
-def find_node_by_id(node: ChatNode, target_id: str) -> Optional[ChatNode]:
-    """Recursively find a node by its ID."""
-    if node.id == target_id:
-        return node
-    for child in node.children:
-        result = find_node_by_id(child, target_id)
-        if result:
-            return result
-    return None
-
-
 def encode_image(image_path: str) -> str:
     """Encode an image file to base64."""
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode("utf-8")
 
 
+def get_image_data_url(file_uuid: str, file_info: dict) -> str:
+    """Get an image file as a base64 data URL, cached by UUID and mtime."""
+    key = (file_uuid, os.path.getmtime(file_info["path"]))
+    data_url = image_cache.get(key)
+    if data_url is None:
+        mime_type = file_info.get("mime_type", "image/jpeg")
+        with span("encode_image", file=file_uuid):
+            data_url = f"data:{mime_type};base64,{encode_image(file_info['path'])}"
+        image_cache.put(key, data_url)
+    return data_url
+
+
 def is_image_file(file_info: dict) -> bool:
     """Check if a file is an image based on its MIME type."""
     mime_type = file_info.get("mime_type", "")
@@ -204,13 +497,10 @@ def format_message_content(message_content: str, files: List[str]) -> List[Dict]
         if is_image_file(file_info):
             # Handle image files
             try:
-                base64_image = encode_image(file_info["path"])
-                mime_type = file_info.get("mime_type", "image/jpeg")
-                print(mime_type)
                 content.append(
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:{mime_type};base64,{base64_image}"},
+                        "image_url": {"url": get_image_data_url(file_uuid, file_info)},
                     }
                 )
             except Exception as e:
@@ -239,44 +529,863 @@ def format_message_content(message_content: str, files: List[str]) -> List[Dict]
     return content
 
 
+def get_chat(chat_id: str, pin: bool = False) -> Optional[Chat]:
+    """Get a chat with its tree loaded, hydrating it from disk if needed.
+
+    Pinned chats are never evicted; release them with unpin_chat. A tree is
+    (re)loaded under the chat's lock only, so it never replaces one that a
+    change to the chat is using, and other chats stay usable meanwhile.
+    """
+    with chats_lock:
+        chat = chats.get(chat_id)
+        if not chat:
+            return None
+        if chat.tree is not None and not (chat.stale and not chat.pins):
+            return use_chat(chat, pin)
+        lock = chat_locks.setdefault(chat_id, threading.RLock())
+
+    with lock:
+        with chats_lock:
+            chat = chats.get(chat_id)
+            if not chat:
+                return None
+            if chat.tree is not None and not (chat.stale and not chat.pins):
+                return use_chat(chat, pin)
+            seen_version = chat.version
+
+        # Read through the writer, so saves still queued are not lost
+        with storage_seconds.time(operation="load_chat"), span("load_chat"):
+            data = writer.load_chat(chat_id)
+            tree = ChatTree.from_dict(data["tree"]) if data else None
+
+        with chats_lock:
+            if tree is None or chats.get(chat_id) is not chat:
+                return None
+            if chat.stale:
+                # Marked again if another worker changed it during the load
+                chat.stale = chat.version != seen_version
+                chat.version = next(version_counter)
+            chat.tree = tree
+            chat.rev = data["rev"]
+            return use_chat(chat, pin)
+
+
+def use_chat(chat: Chat, pin: bool) -> Chat:
+    """Pin a loaded chat if asked and mark it most recently used.
+
+    Call with chats_lock held.
+    """
+    if pin:
+        chat.pins += 1
+    loaded_chats[chat.id] = None
+    loaded_chats.move_to_end(chat.id)
+    evict_cold_chats()
+    return chat
+
+
+def chat_lock(chat_id: str) -> threading.RLock:
+    """Get the lock that serializes changes to one chat."""
+    with chats_lock:
+        return chat_locks.setdefault(chat_id, threading.RLock())
+
+
+def unpin_chat(chat: Chat):
+    with chats_lock:
+        chat.pins -= 1
+
+
+def get_request_chat(chat_id: str) -> Optional[Chat]:
+    """Get a chat pinned until the current request ends.
+
+    Its tree can't be evicted or reloaded while the handler uses it.
+    """
+    chat = get_chat(chat_id, pin=True)
+    if chat:
+        g.setdefault("pinned_chats", []).append(chat)
+    return chat
+
+
+def evict_cold_chats():
+    """Unload least recently used trees until the memory budget is met."""
+    loaded_nodes = sum(len(chats[chat_id].tree.nodes) for chat_id in loaded_chats)
+    # The most recently used chat is the one being accessed; always keep it
+    for chat_id in list(loaded_chats)[:-1]:
+        if len(loaded_chats) <= MAX_LOADED_CHATS and loaded_nodes <= MAX_LOADED_NODES:
+            break
+        chat = chats[chat_id]
+        if chat.pins:
+            continue
+        loaded_nodes -= len(chat.tree.nodes)
+        chat.tree = None
+        del loaded_chats[chat_id]
+
+
 def get_conversation_path(chat_id: str, node_id: str) -> List[Dict]:
     """Get the conversation path from root to the specified node."""
-    if chat_id not in chats:
+    chat = get_chat(chat_id, pin=True)
+    if not chat:
         return []
+    try:
+        nodes = chat.tree.path_to(node_id)
+    finally:
+        unpin_chat(chat)
 
-    chat = chats[chat_id]
     path = []
-    current = find_node_by_id(chat.tree.root, node_id)
-
-    if not current:
-        return path
-
-    # Build path from current node back to root
-    temp_path = []
-    while current:
+    for current in nodes:
         # Format message for multimodal API
         message = current.message.copy()
 
         if current.role == "user" and ("files" in message and message["files"]):
             # Convert user messages with files to multimodal format
-            content = format_message_content(
-                message.get("content", ""), message["files"]
-            )
+            with span("format_message_content", files=len(message["files"])):
+                content = format_message_content(
+                    message.get("content", ""), message["files"]
+                )
             message["content"] = content
             # Remove the files field as it's now incorporated into content
             if "files" in message:
                 del message["files"]
 
-        temp_path.append(message)
+        path.append(message)
+
+    return path
+
 
-        if current.parent_id:
-            current = find_node_by_id(chat.tree.root, current.parent_id)
+def sse(event) -> str:
+    """Format an event dict (or an already-encoded JSON string) as an SSE message."""
+    data = event if isinstance(event, str) else json.dumps(event)
+    return f"data: {data}\n\n"
+
+
+def read_ahead(events):
+    """Iterate events on a helper thread, returning (queue, stop event).
+
+    The queue gets ("event", event) items, then ("error", exception) if the
+    iterator raised, then ("done", None). Setting the stop event makes the
+    helper close the iterator at its next event. The helper runs in a copy
+    of the caller's context so trace spans still nest correctly.
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+
+    def run():
+        try:
+            for event in events:
+                if stop.is_set():
+                    break
+                items.put(("event", event))
+        except Exception as e:
+            items.put(("error", e))
+        finally:
+            if hasattr(events, "close"):
+                events.close()
+            items.put(("done", None))
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(run,), daemon=True).start()
+    return items, stop
+
+
+def aread_ahead(events):
+    """Iterate an async iterator in a task of its own, returning (queue, task).
+
+    The asyncio queue gets the same items as read_ahead's. Cancelling the
+    task stops the iteration. The task runs in a copy of the caller's
+    context, like any task, so trace spans still nest correctly.
+    """
+    items = asyncio.Queue()
+
+    async def run():
+        try:
+            async for event in events:
+                items.put_nowait(("event", event))
+        except Exception as e:
+            items.put_nowait(("error", e))
+        finally:
+            items.put_nowait(("done", None))
+
+    return items, asyncio.ensure_future(run())
+
+
+class DeltaBatch:
+    """Content, reasoning and timings deltas waiting to be sent together.
+
+    Holds the batching rules of coalesce_events and acoalesce_events.
+    """
+
+    def __init__(self, window_ms, max_chars):
+        self.window_ms = window_ms
+        self.max_chars = max_chars
+        self.content = self.reasoning = ""
+        self.timings = None
+        self.started = None
+        self.first_token_sent = False
+
+    def timeout(self):
+        """Seconds until the batch is due, or None while it is empty."""
+        if self.started is None:
+            return None
+        return max(0, self.started + self.window_ms / 1000 - time.monotonic())
+
+    def add(self, event):
+        """Add an event and get the events to send now."""
+        kind = event.get("type") if isinstance(event, dict) else None
+        if kind not in ("content", "reasoning_content", "timings"):
+            return self.flush() + [event]
+
+        if kind == "content":
+            self.content += event["content"]
+        elif kind == "reasoning_content":
+            self.reasoning += event["content"]
         else:
-            break
+            self.timings = event["timings"]
+
+        if self.started is None:
+            self.started = time.monotonic()
+        chars = len(self.content) + len(self.reasoning)
+        if chars >= self.max_chars or (chars and not self.first_token_sent):
+            self.first_token_sent = self.first_token_sent or chars > 0
+            return self.flush()
+        return []
 
-    # Reverse to get root-to-current order
-    path = list(reversed(temp_path))
-    return path
+    def flush(self):
+        """Empty the batch, getting its merged events."""
+        events = []
+        if self.timings is not None:
+            events.append({"type": "timings", "timings": self.timings})
+        if self.reasoning:
+            events.append({"type": "reasoning_content", "content": self.reasoning})
+        if self.content:
+            events.append({"type": "content", "content": self.content})
+        self.content = self.reasoning = ""
+        self.timings = self.started = None
+        return events
+
+
+def coalesce_events(
+    events, window_ms=STREAM_COALESCE_MS, max_chars=STREAM_COALESCE_CHARS
+):
+    """Merge runs of content/reasoning/timings events into batched events.
+
+    The first content or reasoning delta of a stream is sent at once. After
+    that, a batch is flushed once it is window_ms old, even if upstream has
+    stalled, or once it holds max_chars characters. It is also flushed
+    before any other event, so ordering relative to tool calls, status and
+    the final "complete" event is preserved. Only the latest timings in a
+    batch are kept. Raw passthrough strings are forwarded unbatched.
+    """
+    batch = DeltaBatch(window_ms, max_chars)
+    items, stop = read_ahead(events)
+    try:
+        while True:
+            try:
+                kind, item = items.get(timeout=batch.timeout())
+            except queue.Empty:
+                # The window expired while upstream was quiet
+                yield from batch.flush()
+                continue
+            if kind == "done":
+                break
+            if kind == "error":
+                yield from batch.flush()
+                raise item
+            yield from batch.add(item)
+
+        yield from batch.flush()
+    finally:
+        stop.set()
+
+
+async def acoalesce_events(
+    events, window_ms=STREAM_COALESCE_MS, max_chars=STREAM_COALESCE_CHARS
+):
+    """Like coalesce_events, for an async iterator; no thread is used."""
+    batch = DeltaBatch(window_ms, max_chars)
+    items, reader = aread_ahead(events)
+    try:
+        while True:
+            try:
+                kind, item = await asyncio.wait_for(items.get(), batch.timeout())
+            except asyncio.TimeoutError:
+                # The window expired while upstream was quiet
+                for event in batch.flush():
+                    yield event
+                continue
+            if kind == "done":
+                break
+            if kind == "error":
+                for event in batch.flush():
+                    yield event
+                raise item
+            for event in batch.add(item):
+                yield event
+
+        for event in batch.flush():
+            yield event
+    finally:
+        reader.cancel()
+
+
+def run_tool(tool_name: str, args):
+    """Run a tool's handler, timing it."""
+    with tool_seconds.time(tool=tool_name), span(f"tool:{tool_name}"):
+        return TOOLS[tool_name]["handler"](args)
+
+
+def run_tool_calls(calls: List[tuple], cancel=None):
+    """Run tool calls concurrently and yield (index, result) as each finishes.
+
+    calls is a list of (tool_name, args). A call that raises or runs past its
+    tool's timeout yields an error message as its result instead. Once cancel
+    is set, calls still running are abandoned and nothing more is yielded.
+    """
+    now = time.monotonic()
+    pending = {}
+    stopped = Future()
+    if cancel is not None:
+        unregister = cancel.add_callback(lambda: stopped.set_result(None))
+    else:
+        unregister = lambda: None
+    for index, (tool_name, args) in enumerate(calls):
+        # Run in a copy of the caller's context so the tool's span nests in its trace
+        context = contextvars.copy_context()
+        future = tool_executor.submit(context.run, run_tool, tool_name, args)
+        timeout = TOOLS[tool_name].get("timeout", TOOL_TIMEOUT)
+        pending[future] = (index, tool_name, now + timeout)
+
+    try:
+        while pending:
+            next_deadline = min(deadline for _, _, deadline in pending.values())
+            done, _ = wait(
+                [*pending, stopped],
+                timeout=max(0, next_deadline - time.monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+            if stopped.done():
+                # The worker threads can't be interrupted; their results are dropped
+                for future in pending:
+                    future.cancel()
+                return
+            for future in done:
+                index, tool_name, _ = pending.pop(future)
+                try:
+                    yield index, future.result()
+                except Exception as e:
+                    tool_errors.inc(tool=tool_name)
+                    yield index, f"Error running {tool_name}: {e}"
+
+            now = time.monotonic()
+            for future, (index, tool_name, deadline) in list(pending.items()):
+                if deadline <= now:
+                    # The worker thread can't be interrupted; its result is dropped
+                    future.cancel()
+                    del pending[future]
+                    tool_errors.inc(tool=tool_name)
+                    yield index, f"Error running {tool_name}: timed out"
+    finally:
+        unregister()
+
+
+async def arun_tool(tool_name: str, args):
+    """Run a tool's async handler, or its handler on the tool executor, timing it."""
+    tool = TOOLS[tool_name]
+    with tool_seconds.time(tool=tool_name), span(f"tool:{tool_name}"):
+        if "async_handler" in tool:
+            return await tool["async_handler"](args)
+        # Run in a copy of the context so the tool's spans nest in this one
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            tool_executor, context.run, tool["handler"], args
+        )
+
+
+async def arun_tool_calls(calls: List[tuple], cancel=None):
+    """Like run_tool_calls, but for a coroutine; no thread waits on the calls."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    if cancel is not None:
+        unregister = cancel.add_callback(lambda: loop.call_soon_threadsafe(stopped.set))
+    else:
+        unregister = lambda: None
+    stop_waiter = asyncio.ensure_future(stopped.wait())
+
+    pending = {}
+    for index, (tool_name, args) in enumerate(calls):
+        timeout = TOOLS[tool_name].get("timeout", TOOL_TIMEOUT)
+        task = asyncio.ensure_future(
+            asyncio.wait_for(arun_tool(tool_name, args), timeout)
+        )
+        pending[task] = (index, tool_name)
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                [*pending, stop_waiter], return_when=asyncio.FIRST_COMPLETED
+            )
+            if stopped.is_set():
+                return
+            for task in done:
+                index, tool_name = pending.pop(task)
+                try:
+                    yield index, task.result()
+                except asyncio.TimeoutError:
+                    tool_errors.inc(tool=tool_name)
+                    yield index, f"Error running {tool_name}: timed out"
+                except Exception as e:
+                    tool_errors.inc(tool=tool_name)
+                    yield index, f"Error running {tool_name}: {e}"
+    finally:
+        # Threads running sync handlers can't be interrupted; their results are dropped
+        for task in pending:
+            task.cancel()
+        stop_waiter.cancel()
+        unregister()
+
+
+def start_generation(chat_id: str, cancel: threading.Event):
+    """Register a running generation; setting the event stops it."""
+    with chats_lock:
+        active_generations.setdefault(chat_id, set()).add(cancel)
+
+
+def end_generation(chat_id: str, cancel: threading.Event):
+    with chats_lock:
+        running = active_generations.get(chat_id, set())
+        running.discard(cancel)
+        if not running:
+            active_generations.pop(chat_id, None)
+
+
+def save_response(chat: Chat, current_node: ChatNode, assistant_message) -> str:
+    """Store a model response under current_node and get its node id.
+
+    A response to a tool-calling assistant node is merged into that node.
+    """
+    with chat_lock(chat.id):
+        if current_node.role == "assistant":
+            current_node.content = assistant_message.get("content", "")
+            assistant_node = current_node
+        else:
+            # Create assistant response node
+            assistant_node = ChatNode(
+                id=str(uuid.uuid4()),
+                role="assistant",
+                content=assistant_message.get("content", ""),
+                message=assistant_message,
+                parent_id=current_node.id,
+            )
+
+            chat.tree.add_child(current_node, assistant_node)
+
+        # Update current node to the assistant response
+        chat.tree.current_node_id = assistant_node.id
+
+        # Update chat timestamp
+        chat.updated_at = datetime.now()
+
+        save_chat(chat, assistant_node)
+    return assistant_node.id
+
+
+def build_prompt(chat_id: str, node_id: str, tool_results=()) -> List[Dict]:
+    """Build the prompt for the reply to a node, fitted to the context budget.
+
+    tool_results are appended as tool messages after the node.
+    """
+    with prompt_build_seconds.time(), span("build_prompt"):
+        # Get conversation path up to this node (already formatted for multimodal)
+        messages = get_conversation_path(chat_id, node_id)
+        for result in tool_results:
+            messages.append(
+                {
+                    "role": "tool",
+                    "content": result["content"],
+                    "tool_call_id": result["tool_call_id"],
+                }
+            )
+        with span("fit_context"):
+            return context_builder.fit(messages)
+
+
+def add_tool_call_node(
+    chat: Chat, current_node: ChatNode, assistant_message
+) -> ChatNode:
+    """Add an assistant message that calls tools under current_node.
+
+    It becomes the current node and is saved at once, so the final reply
+    never points at a parent missing from the store.
+    """
+    assistant_node = ChatNode(
+        id=str(uuid.uuid4()),
+        role="assistant",
+        content=assistant_message.get("content", ""),
+        message=assistant_message,
+        tool_calls=assistant_message["tool_calls"],
+        parent_id=current_node.id,
+    )
+    with chat_lock(chat.id):
+        chat.tree.add_child(current_node, assistant_node)
+        chat.tree.current_node_id = assistant_node.id
+        save_chat(chat, assistant_node)
+    return assistant_node
+
+
+def runnable_tool_calls(assistant_message) -> List[tuple]:
+    """Get (tool_call, tool_name, args) for each call that can run.
+
+    Calls with malformed arguments or to disabled tools are skipped.
+    """
+    runnable = []
+    for tool_call in assistant_message["tool_calls"]:
+        tool_name = tool_call["function"]["name"]
+        try:
+            args = json.loads(tool_call["function"]["arguments"])
+        except json.JSONDecodeError:
+            continue
+
+        if tool_name in TOOLS and enabled_tools.get(tool_name, False):
+            runnable.append((tool_call, tool_name, args))
+    return runnable
+
+
+def save_tool_results(
+    chat: Chat, assistant_node: ChatNode, runnable: List[tuple], results: Dict
+) -> List[Dict]:
+    """Record tool results on their node in call order and save it.
+
+    results maps call indexes to results; calls without one were stopped.
+    """
+    tool_results = [
+        {
+            "tool_call_id": tool_call.get("id"),
+            "content": results.get(index, f"Error running {tool_name}: stopped"),
+        }
+        for index, (tool_call, tool_name, _) in enumerate(runnable)
+    ]
+    with chat_lock(chat.id):
+        assistant_node.tool_results = tool_results
+        save_chat(chat, assistant_node)
+    return tool_results
+
+
+def tool_call_event(tool_call, tool_name: str, args) -> Dict:
+    return {
+        "type": "tool_call",
+        "name": tool_name,
+        "tool_call_id": tool_call.get("id"),
+        "args": args,
+    }
+
+
+def tool_result_event(tool_call, tool_name: str, result) -> Dict:
+    return {
+        "type": "tool_result",
+        "name": tool_name,
+        "tool_call_id": tool_call.get("id"),
+        "result": result,
+    }
+
+
+def finished_event(node_id: str, stopped: bool) -> Dict:
+    finished = {"type": "finished", "node_id": node_id, "stopped": stopped}
+    active = current_trace()
+    if TRACE_DEBUG and active is not None:
+        finished["trace"] = active.summary()
+    return finished
+
+
+def generate_response(chat_id: str, node_id: str, cancel: threading.Event):
+    """Generate the reply to a node as SSE strings, saving it when done.
+
+    Runs inside a generation job; setting cancel stops the model early.
+    """
+    with span("get_chat"):
+        chat = get_chat(chat_id, pin=True)
+    if not chat:
+        yield sse({"type": "error", "content": "Chat not found"})
+        return
+
+    start_generation(chat_id, cancel)
+    ticket = scheduler.enqueue(chat_id)
+    try:
+        # Wait for a free generation slot, reporting the queue position
+        queued_at = time.perf_counter()
+        for position in scheduler.wait(ticket, cancel):
+            yield sse(
+                {
+                    "type": "status",
+                    "content": f"Waiting in queue (position {position})...",
+                    "queue_position": position,
+                }
+            )
+        record_span("queue_wait", queued_at, time.perf_counter())
+        if cancel.is_set():
+            yield sse({"type": "error", "content": "Generation stopped"})
+            return
+
+        with span("find_node"):
+            current_node = chat.tree.get_node(node_id)
+        if not current_node:
+            yield sse({"type": "error", "content": "Node not found"})
+            return
+
+        yield sse({"type": "status", "content": "Starting response..."})
+
+        messages = build_prompt(chat_id, node_id)
+
+        # Stream initial response
+        response_generator = coalesce_events(
+            llama_chat_stream(messages, enabled_tools, cache_key=chat_id, cancel=cancel)
+        )
+        assistant_message = None
+        stopped = False
+
+        for event in response_generator:
+            if isinstance(event, dict) and event["type"] == "complete":
+                assistant_message = event["message"]
+                stopped = event["stopped"]
+                break
+            else:
+                yield sse(event)
+
+        if not assistant_message:
+            if cancel.is_set():
+                yield sse({"type": "error", "content": "Generation stopped"})
+            else:
+                yield sse({"type": "error", "content": "No response from model"})
+            return
+
+        # Handle tool calls if present
+        if "tool_calls" in assistant_message and assistant_message["tool_calls"]:
+            # Add assistant message with tool calls to conversation
+            assistant_node = add_tool_call_node(chat, current_node, assistant_message)
+            current_node = assistant_node
+
+            # Execute tool calls
+            runnable = runnable_tool_calls(assistant_message)
+            for tool_call, tool_name, args in runnable:
+                yield sse(tool_call_event(tool_call, tool_name, args))
+
+            # Stream each result as it finishes, but record them in call order
+            results = {}
+            calls = [(tool_name, args) for _, tool_name, args in runnable]
+            for index, result in run_tool_calls(calls, cancel):
+                results[index] = result
+                tool_call, tool_name, _ = runnable[index]
+
+                # Send tool result to UI
+                yield sse(tool_result_event(tool_call, tool_name, result))
+
+            tool_results = save_tool_results(chat, assistant_node, runnable, results)
+
+            if cancel.is_set():
+                # Stopped while the tools ran: don't send the model another prompt
+                stopped = True
+            else:
+                yield sse({"type": "status", "content": "Processing tool results..."})
+
+                # Generate final response with tool results
+                messages = build_prompt(chat_id, assistant_node.id, tool_results)
+
+                # Stream final response after tool calls
+                final_generator = coalesce_events(
+                    llama_chat_stream(
+                        messages, enabled_tools, cache_key=chat_id, cancel=cancel
+                    )
+                )
+                for event in final_generator:
+                    if isinstance(event, dict) and event["type"] == "complete":
+                        assistant_message = event["message"]
+                        stopped = event["stopped"]
+                        break
+                    else:
+                        yield sse(event)
+                else:
+                    # Stopped before the model sent anything; keep the tool results
+                    stopped = cancel.is_set()
+
+        new_id = save_response(chat, current_node, assistant_message)
+        yield sse(finished_event(new_id, stopped))
+
+    except QueueTimeout as e:
+        yield sse({"type": "error", "content": str(e)})
+    except Exception as e:
+        yield sse({"type": "error", "content": f"Error: {str(e)}"})
+    finally:
+        scheduler.release(ticket)
+        end_generation(chat_id, cancel)
+        unpin_chat(chat)
+
+
+async def agenerate_response(chat_id: str, node_id: str, cancel: threading.Event):
+    """Like generate_response, but as an async generator on the event loop.
+
+    Queueing, the llama-server stream and async tool handlers wait without
+    a thread. Loading the chat, building the prompt and saving, which may
+    touch the disk, run briefly on the default thread pool.
+    """
+    with span("get_chat"):
+        chat = await asyncio.to_thread(get_chat, chat_id, True)
+    if not chat:
+        yield sse({"type": "error", "content": "Chat not found"})
+        return
+
+    start_generation(chat_id, cancel)
+    ticket = scheduler.enqueue(chat_id)
+    try:
+        # Wait for a free generation slot, reporting the queue position
+        queued_at = time.perf_counter()
+        async for position in scheduler.await_grant(ticket, cancel):
+            yield sse(
+                {
+                    "type": "status",
+                    "content": f"Waiting in queue (position {position})...",
+                    "queue_position": position,
+                }
+            )
+        record_span("queue_wait", queued_at, time.perf_counter())
+        if cancel.is_set():
+            yield sse({"type": "error", "content": "Generation stopped"})
+            return
+
+        with span("find_node"):
+            current_node = chat.tree.get_node(node_id)
+        if not current_node:
+            yield sse({"type": "error", "content": "Node not found"})
+            return
+
+        yield sse({"type": "status", "content": "Starting response..."})
+
+        messages = await asyncio.to_thread(build_prompt, chat_id, node_id)
+
+        assistant_message = None
+        stopped = False
+        async for event in acoalesce_events(
+            allama_chat_stream(
+                messages, enabled_tools, cache_key=chat_id, cancel=cancel
+            )
+        ):
+            if isinstance(event, dict) and event["type"] == "complete":
+                assistant_message = event["message"]
+                stopped = event["stopped"]
+            else:
+                yield sse(event)
+
+        if not assistant_message:
+            if cancel.is_set():
+                yield sse({"type": "error", "content": "Generation stopped"})
+            else:
+                yield sse({"type": "error", "content": "No response from model"})
+            return
+
+        if "tool_calls" in assistant_message and assistant_message["tool_calls"]:
+            assistant_node = await asyncio.to_thread(
+                add_tool_call_node, chat, current_node, assistant_message
+            )
+            current_node = assistant_node
+
+            runnable = runnable_tool_calls(assistant_message)
+            for tool_call, tool_name, args in runnable:
+                yield sse(tool_call_event(tool_call, tool_name, args))
+
+            # Stream each result as it finishes, but record them in call order
+            results = {}
+            calls = [(tool_name, args) for _, tool_name, args in runnable]
+            async for index, result in arun_tool_calls(calls, cancel):
+                results[index] = result
+                tool_call, tool_name, _ = runnable[index]
+                yield sse(tool_result_event(tool_call, tool_name, result))
+
+            tool_results = await asyncio.to_thread(
+                save_tool_results, chat, assistant_node, runnable, results
+            )
+
+            if cancel.is_set():
+                # Stopped while the tools ran: don't send the model another prompt
+                stopped = True
+            else:
+                yield sse({"type": "status", "content": "Processing tool results..."})
+                messages = await asyncio.to_thread(
+                    build_prompt, chat_id, assistant_node.id, tool_results
+                )
+
+                completed = False
+                async for event in acoalesce_events(
+                    allama_chat_stream(
+                        messages, enabled_tools, cache_key=chat_id, cancel=cancel
+                    )
+                ):
+                    if isinstance(event, dict) and event["type"] == "complete":
+                        assistant_message = event["message"]
+                        stopped = event["stopped"]
+                        completed = True
+                    else:
+                        yield sse(event)
+                if not completed:
+                    # Stopped before the model sent anything; keep the tool results
+                    stopped = cancel.is_set()
+
+        new_id = await asyncio.to_thread(
+            save_response, chat, current_node, assistant_message
+        )
+        yield sse(finished_event(new_id, stopped))
+
+    except QueueTimeout as e:
+        yield sse({"type": "error", "content": str(e)})
+    except Exception as e:
+        yield sse({"type": "error", "content": f"Error: {str(e)}"})
+    finally:
+        scheduler.release(ticket)
+        end_generation(chat_id, cancel)
+        unpin_chat(chat)
+
+
+def traced_generation(chat_id: str, node_id: str, cancel: threading.Event):
+    """Run generate_response inside a trace of the whole generation."""
+    with trace("generation", chat_id=chat_id, node_id=node_id):
+        yield from generate_response(chat_id, node_id, cancel)
+
+
+async def atraced_generation(chat_id: str, node_id: str, cancel: threading.Event):
+    """Run agenerate_response inside a trace of the whole generation."""
+    with trace("generation", chat_id=chat_id, node_id=node_id):
+        async for text in agenerate_response(chat_id, node_id, cancel):
+            yield text
+
+
+def open_stream(
+    chat_id: str,
+    node_id: str,
+    last_event_id: Optional[str] = None,
+    join_only: bool = False,
+    loop: Optional[asyncio.AbstractEventLoop] = None,
+):
+    """Get the generation job to stream for a node and the event id to start after.
+
+    A client that sends the last event id it saw resumes after it; otherwise
+    it joins the running job from its start, or a new job is started. With
+    join_only, a job is never started: a client rejoining a generation it
+    saw running gets (None, 0) once that job is done. So does a resume whose
+    job has expired. Answer (None, 0) with 204, which tells EventSource to
+    stop reconnecting instead of generating again. A new job runs on loop
+    (as agenerate_response) when one is given, else on a thread.
+    """
+    if last_event_id:
+        job = generation_jobs.get((chat_id, node_id))
+        if job is None:
+            return None, 0
+        return job, int(last_event_id) if last_event_id.isdigit() else 0
+    if join_only:
+        job = generation_jobs.get((chat_id, node_id))
+        if job is None or job.done:
+            return None, 0
+        return job, 0
+
+    if loop is None:
+        run = partial(traced_generation, chat_id, node_id)
+    else:
+        run = partial(atraced_generation, chat_id, node_id)
+    return generation_jobs.start((chat_id, node_id), run, loop), 0
 
 
 def generate_chat_title(content: str) -> str:
@@ -288,34 +1397,68 @@ def generate_chat_title(content: str) -> str:
     return title
 
 
-def save_chats():
-    """Save all chats to disk."""
-    data = {
-        "chats": {chat_id: chat.to_dict() for chat_id, chat in chats.items()},
-        "global_files": global_files,
-        "enabled_tools": enabled_tools,
-    }
-    with open("chats.pkl", "wb") as f:
-        pickle.dump(data, f)
+def save_chat(chat: Chat, *nodes: ChatNode):
+    """Persist a chat's metadata and the given (new or changed) nodes.
+
+    Saves of a chat that has been deleted (e.g. by a generation that was
+    still running) are dropped.
+    """
+    global chats_version
+    if chats.get(chat.id) is not chat:
+        return
+    with span("save_chat"):
+        record = chat.to_record()
+        node_records = [node.to_record() for node in nodes]
+        if APP_WORKERS > 1:
+            # Write through, and notice if another worker saved the chat since
+            # this process last loaded it
+            with storage_seconds.time(operation="save_chat"):
+                rev = store.save_chat(record, node_records)
+            if rev != chat.rev + 1:
+                chat.stale = True
+            chat.rev = rev
+        else:
+            writer.save_chat(record, node_records)
+    with chats_lock:
+        # Deleted while it was being written
+        if chats.get(chat.id) is not chat:
+            return
+        chat_index.update(chat)
+        chat.version = chats_version = next(version_counter)
 
 
 def load_chats():
-    """Load all chats from disk."""
-    global chats, global_files, enabled_tools
-    try:
-        with open("chats.pkl", "rb") as f:
-            data = pickle.load(f)
-            chats = {
-                chat_id: Chat.from_dict(chat_data)
-                for chat_id, chat_data in data.get("chats", {}).items()
-            }
-            global_files = data.get("global_files", {})
-            enabled_tools = data.get(
-                "enabled_tools",
-                {"calculator": True, "web_search": True, "read_url": True},
-            )
-    except FileNotFoundError:
-        pass  # Use default empty chats
+    """Load chat metadata from disk, migrating a legacy chats.pkl if present.
+
+    Chat trees are not loaded here; get_chat hydrates them on first access.
+    """
+    global chats, global_files, enabled_tools, synced_seq
+    if store.migrate_from_pickle(LEGACY_CHATS_FILE):
+        print(f"Migrated {LEGACY_CHATS_FILE} into {CHATS_DB}")
+    # Taken first, so a write racing the load is picked up again by the next sync
+    synced_seq = store.current_seq()
+    with storage_seconds.time(operation="load_chats"):
+        records = store.load_chat_index()
+    chats = {record["id"]: Chat.from_record(record) for record in records}
+    loaded_chats.clear()
+    chat_index.rebuild(list(chats.values()))
+    global_files = store.load_files()
+    enabled_tools = store.load_setting(
+        "enabled_tools",
+        {"calculator": True, "web_search": True, "read_url": True},
+    )
+
+
+def conditional_json(etag: str, build):
+    """Answer 304 if the client already has this ETag, else jsonify build()."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    # Let clients keep the body but always revalidate it
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 def get_file_content(file_uuid: str) -> str:
@@ -330,12 +1473,32 @@ def get_file_content(file_uuid: str) -> str:
         return f"[Image: {file_info.get('filename', 'unknown')}]"
 
     try:
-        with open(file_info["path"], "r", encoding="utf-8") as f:
-            return f.read()
+        key = (file_uuid, os.path.getmtime(file_info["path"]))
+        content = text_cache.get(key)
+        if content is None:
+            content = read_text_file(file_info["path"])
+            text_cache.put(key, content)
+        return content
     except Exception as e:
         return f"Error reading file: {e}"
 
 
+def read_text_file(path: str) -> str:
+    """Read a UTF-8 text file, memory-mapping it if it is large."""
+    if os.path.getsize(path) < MMAP_THRESHOLD:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    # Decode straight from the mapping rather than copying into a bytes object
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            text = str(m, "utf-8")
+            if m.find(b"\r") != -1:
+                # Match the newline translation of text-mode reads
+                text = text.replace("\r\n", "\n").replace("\r", "\n")
+            return text
+
+
 def create_new_chat() -> str:
     """Create a new chat and return its ID."""
     chat_id = str(uuid.uuid4())
@@ -356,16 +1519,68 @@ def create_new_chat() -> str:
     # Create new chat
     chat = Chat(id=chat_id, title="New Chat", tree=tree)
 
-    chats[chat_id] = chat
-    save_chats()
+    with chats_lock:
+        chats[chat_id] = chat
+        loaded_chats[chat_id] = None
+        evict_cold_chats()
+    save_chat(chat, tree.root)
     return chat_id
 
 
+def sync_shared_state():
+    """Pick up chats, files and settings changed by other worker processes.
+
+    Only rows written since the last sync are read. Changed chats are
+    marked stale and reloaded on their next access.
+    """
+    global chats_version, files_version, synced_seq
+    if not store.changed_elsewhere():
+        return
+
+    records, deleted, files, synced_seq = store.changes_since(synced_seq)
+    with chats_lock:
+        for chat_id in deleted:
+            if chats.pop(chat_id, None) is not None:
+                loaded_chats.pop(chat_id, None)
+                chat_index.remove(chat_id)
+        for record in records:
+            chat = chats.get(record["id"])
+            if chat is None:
+                chat = chats[record["id"]] = Chat.from_record(record)
+            elif chat.rev != record["rev"]:
+                chat.title = record["title"]
+                chat.updated_at = datetime.fromisoformat(record["updated_at"])
+                chat.stale = True
+                chat.version = next(version_counter)
+            else:
+                continue
+            chat_index.update(chat)
+        if records or deleted:
+            chats_version = next(version_counter)
+
+    if files:
+        global_files.update(files)
+        files_version = next(version_counter)
+    enabled_tools.update(store.load_setting("enabled_tools", {}))
+
+
 # --------------------
 # FLASK ROUTES
 # --------------------
 
 
+@app.before_request
+def sync_workers():
+    if APP_WORKERS > 1:
+        sync_shared_state()
+
+
+@app.teardown_request
+def unpin_request_chats(exc):
+    for chat in g.pop("pinned_chats", []):
+        unpin_chat(chat)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
@@ -404,21 +1619,27 @@ def index():
 @app.route("/api/chats")
 @login_required
 def list_chats():
-    """Get list of all chats."""
-    chat_list = []
-    for chat in chats.values():
-        chat_list.append(
-            {
-                "id": chat.id,
-                "title": chat.title,
-                "created_at": chat.created_at.isoformat(),
-                "updated_at": chat.updated_at.isoformat(),
-            }
-        )
+    """Get chats sorted by updated_at descending.
+
+    Supports ?limit=N&cursor=...&q=title-search; when more results remain the
+    cursor for the next page is returned in the X-Next-Cursor header.
+    """
+    limit = request.args.get("limit", type=int)
+    cursor = request.args.get("cursor")
+    query = request.args.get("q", "")
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be at least 1"}), 400
+    # Read the version first so a concurrent change can only make the ETag stale
+    etag = f"chats-{BOOT_ID}-{chats_version}"
+    try:
+        chat_list, next_cursor = chat_index.page(limit, cursor, query)
+    except ValueError:
+        return jsonify({"error": "Bad cursor"}), 400
 
-    # Sort by updated_at descending
-    chat_list.sort(key=lambda x: x["updated_at"], reverse=True)
-    return jsonify(chat_list)
+    response = conditional_json(etag, lambda: chat_list)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @app.route("/api/chats/new", methods=["POST"])
@@ -433,27 +1654,95 @@ def create_chat():
 @login_required
 def delete_chat(chat_id):
     """Delete a chat."""
-    if chat_id in chats:
-        del chats[chat_id]
-        save_chats()
-        return jsonify({"success": True})
-    return jsonify({"error": "Chat not found"}), 404
+    global chats_version
+    with chats_lock:
+        if chats.pop(chat_id, None) is None:
+            return jsonify({"error": "Chat not found"}), 404
+        chats_version = next(version_counter)
+        loaded_chats.pop(chat_id, None)
+        chat_locks.pop(chat_id, None)
+        chat_index.remove(chat_id)
+        # Stop its generations rather than keep the model busy for nothing
+        running = list(active_generations.get(chat_id, ()))
+    for cancel in running:
+        cancel.set()
+    writer.delete_chat(chat_id)
+    return jsonify({"success": True})
 
 
 @app.route("/api/chats/<chat_id>/tree")
 @login_required
 def get_chat_tree(chat_id):
     """Get the chat tree for a specific chat."""
-    if chat_id not in chats:
+    chat = get_request_chat(chat_id)
+    if not chat:
         return jsonify({"error": "Chat not found"}), 404
 
-    chat = chats[chat_id]
-    return jsonify(
-        {
+    return conditional_json(
+        f"chat-{BOOT_ID}-{chat.version}-tree",
+        lambda: {
             "tree": chat.tree.to_dict(),
             "current_node_id": chat.tree.current_node_id,
             "title": chat.title,
-        }
+        },
+    )
+
+
+@app.route("/api/chats/<chat_id>/path")
+@login_required
+def get_chat_path(chat_id):
+    """Get the nodes from the root to the current node, without other branches."""
+    chat = get_request_chat(chat_id)
+    if not chat:
+        return jsonify({"error": "Chat not found"}), 404
+
+    return conditional_json(
+        f"chat-{BOOT_ID}-{chat.version}-path",
+        lambda: {
+            "path": [
+                node.to_view() for node in chat.tree.path_to(chat.tree.current_node_id)
+            ],
+            "current_node_id": chat.tree.current_node_id,
+            "title": chat.title,
+        },
+    )
+
+
+@app.route("/api/chats/<chat_id>/nodes/<node_id>/siblings")
+@login_required
+def get_node_siblings(chat_id, node_id):
+    """Get a node and its siblings (the alternatives at its branch point)."""
+    chat = get_request_chat(chat_id)
+    if not chat:
+        return jsonify({"error": "Chat not found"}), 404
+
+    node = chat.tree.get_node(node_id)
+    if not node:
+        return jsonify({"error": "Node not found"}), 404
+
+    siblings = node.parent.children if node.parent else [node]
+    return conditional_json(
+        f"chat-{BOOT_ID}-{chat.version}-siblings-{node_id}",
+        lambda: {"siblings": [sibling.to_view() for sibling in siblings]},
+    )
+
+
+@app.route("/api/chats/<chat_id>/nodes/<node_id>/subtree")
+@login_required
+def get_node_subtree(chat_id, node_id):
+    """Get the subtree under a node, limited to ?depth=N levels (default 1)."""
+    chat = get_request_chat(chat_id)
+    if not chat:
+        return jsonify({"error": "Chat not found"}), 404
+
+    node = chat.tree.get_node(node_id)
+    if not node:
+        return jsonify({"error": "Node not found"}), 404
+
+    depth = max(request.args.get("depth", 1, type=int), 0)
+    return conditional_json(
+        f"chat-{BOOT_ID}-{chat.version}-subtree-{node_id}-{depth}",
+        lambda: {"node": node.to_view(depth)},
     )
 
 
@@ -461,7 +1750,8 @@ def get_chat_tree(chat_id):
 @login_required
 def send_message(chat_id):
     """Send a message to a specific chat."""
-    if chat_id not in chats:
+    chat = get_request_chat(chat_id)
+    if not chat:
         return jsonify({"error": "Chat not found"}), 404
 
     data = request.json
@@ -475,50 +1765,51 @@ def send_message(chat_id):
     if not message_content.strip() and not files:
         return jsonify({"error": "Message cannot be empty"}), 400
 
-    chat = chats[chat_id]
-
-    # Create new user message node
-    user_node = ChatNode(
-        id=str(uuid.uuid4()),
-        role="user",
-        content=message_content,
-        message={"role": "user", "content": message_content, "files": files},
-        files=files,
-        parent_id=chat.tree.current_node_id,
-    )
+    with chat_lock(chat_id):
+        # Create new user message node
+        user_node = ChatNode(
+            id=str(uuid.uuid4()),
+            role="user",
+            content=message_content,
+            message={"role": "user", "content": message_content, "files": files},
+            files=files,
+            parent_id=chat.tree.current_node_id,
+        )
 
-    # Add user node to current node's children
-    current_node = find_node_by_id(chat.tree.root, chat.tree.current_node_id)
+        # Add user node to current node's children
+        current_node = chat.tree.get_node(chat.tree.current_node_id)
 
-    if not current_node:
-        return jsonify({"error": "Node not found"}), 404
+        if not current_node:
+            return jsonify({"error": "Node not found"}), 404
 
-    current_node.children.append(user_node)
+        chat.tree.add_child(current_node, user_node)
 
-    # Update current node to the user message
-    chat.tree.current_node_id = user_node.id
+        # Update current node to the user message
+        chat.tree.current_node_id = user_node.id
 
-    # Update chat title if this is the first user message
-    updated_title = None
-    if chat.title == "New Chat":
-        if message_content.strip():
-            chat.title = generate_chat_title(message_content)
-        elif files:
-            # Generate title based on file types if no text content
-            image_count = sum(
-                1 for f in files if f in global_files and is_image_file(global_files[f])
-            )
-            file_count = len(files)
-            if image_count > 0:
-                chat.title = f"Images and files ({file_count} files)"
-            else:
-                chat.title = f"Files ({file_count} files)"
-        updated_title = chat.title
+        # Update chat title if this is the first user message
+        updated_title = None
+        if chat.title == "New Chat":
+            if message_content.strip():
+                chat.title = generate_chat_title(message_content)
+            elif files:
+                # Generate title based on file types if no text content
+                image_count = sum(
+                    1
+                    for f in files
+                    if f in global_files and is_image_file(global_files[f])
+                )
+                file_count = len(files)
+                if image_count > 0:
+                    chat.title = f"Images and files ({file_count} files)"
+                else:
+                    chat.title = f"Files ({file_count} files)"
+            updated_title = chat.title
 
-    # Update chat timestamp
-    chat.updated_at = datetime.now()
+        # Update chat timestamp
+        chat.updated_at = datetime.now()
 
-    save_chats()
+        save_chat(chat, user_node)
 
     response_data = {"success": True, "node_id": user_node.id}
     if updated_title:
@@ -534,158 +1825,49 @@ def stream_response(chat_id, node_id):
     if chat_id not in chats:
         return Response("Chat not found", status=404)
 
-    def generate():
-        try:
-            # Get conversation path up to this node (already formatted for multimodal)
-            messages = get_conversation_path(chat_id, node_id)
-
-            yield "data: " + json.dumps(
-                {"type": "status", "content": "Starting response..."}
-            ) + "\n\n"
-
-            # Stream initial response
-            response_generator = llama_chat_stream(messages, enabled_tools)
-            assistant_message = None
-
-            for chunk_data in response_generator:
-                chunk = json.loads(chunk_data)
-
-                if chunk["type"] == "complete":
-                    assistant_message = chunk["message"]
-                    break
-                else:
-                    yield f"data: {chunk_data}\n\n"
-
-            if not assistant_message:
-                yield "data: " + json.dumps(
-                    {"type": "error", "content": "No response from model"}
-                ) + "\n\n"
-                return
-
-            current_node = find_node_by_id(chats[chat_id].tree.root, node_id)
-
-            if not current_node:
-                yield "data: " + json.dumps(
-                    {"type": "error", "content": "Node not found"}
-                ) + "\n\n"
-                return
-
-            # Handle tool calls if present
-            if "tool_calls" in assistant_message and assistant_message["tool_calls"]:
-                # Add assistant message with tool calls to conversation
-                assistant_node = ChatNode(
-                    id=str(uuid.uuid4()),
-                    role="assistant",
-                    content=assistant_message.get("content", ""),
-                    message=assistant_message,
-                    tool_calls=assistant_message["tool_calls"],
-                    parent_id=node_id,
-                )
-                current_node.children.append(assistant_node)
-                chats[chat_id].tree.current_node_id = assistant_node.id
-                current_node = assistant_node
-
-                # Execute tool calls
-                tool_results = []
-                for tool_call in assistant_message["tool_calls"]:
-                    tool_name = tool_call["function"]["name"]
-                    try:
-                        args = json.loads(tool_call["function"]["arguments"])
-                    except json.JSONDecodeError:
-                        continue
-
-                    if tool_name in TOOLS and enabled_tools.get(tool_name, False):
-                        yield "data: " + json.dumps(
-                            {
-                                "type": "tool_call",
-                                "name": tool_name,
-                                "args": args,
-                            }
-                        ) + "\n\n"
-                        result = TOOLS[tool_name]["handler"](args)
-                        tool_results.append(
-                            {"tool_call_id": tool_call.get("id"), "content": result}
-                        )
-
-                        # Send tool result to UI
-                        yield "data: " + json.dumps(
-                            {
-                                "type": "tool_result",
-                                "tool_call_id": tool_call.get("id"),
-                                "result": result,
-                            }
-                        ) + "\n\n"
-
-                assistant_node.tool_results = tool_results
-                save_chats()
-
-                # Generate final response with tool results
-                messages = get_conversation_path(chat_id, assistant_node.id)
-                for result in tool_results:
-                    messages.append(
-                        {
-                            "role": "tool",
-                            "content": result["content"],
-                            "tool_call_id": result["tool_call_id"],
-                        }
-                    )
-
-                # Stream final response after tool calls
-                yield "data: " + json.dumps(
-                    {"type": "status", "content": "Processing tool results..."}
-                ) + "\n\n"
-
-                final_generator = llama_chat_stream(messages, enabled_tools)
-                for chunk_data in final_generator:
-                    chunk = json.loads(chunk_data)
-
-                    if chunk["type"] == "complete":
-                        assistant_message = chunk["message"]
-                        break
-                    else:
-                        yield f"data: {chunk_data}\n\n"
-
-            if current_node.role == "assistant":
-                current_node.content = assistant_message.get("content", "")
-                new_id = current_node.id
-            else:
-                # Create assistant response node
-                assistant_node = ChatNode(
-                    id=str(uuid.uuid4()),
-                    role="assistant",
-                    content=assistant_message.get("content", ""),
-                    message=assistant_message,
-                    parent_id=node_id,
-                )
-
-                current_node.children.append(assistant_node)
-
-                # Update current node to the assistant response
-                chats[chat_id].tree.current_node_id = assistant_node.id
-                new_id = assistant_node.id
+    job, after = open_stream(
+        chat_id,
+        node_id,
+        request.headers.get("Last-Event-ID"),
+        join_only=request.args.get("resume") == "1",
+    )
+    if job is None:
+        return Response(status=204)
 
-            # Update chat timestamp
-            chats[chat_id].updated_at = datetime.now()
+    return Response(
+        job.events(after),
+        mimetype="text/event-stream",
+        headers=SSE_HEADERS,
+    )
 
-            save_chats()
 
-            yield "data: " + json.dumps(
-                {"type": "finished", "node_id": new_id}
-            ) + "\n\n"
+@app.route("/api/chats/<chat_id>/generation")
+@login_required
+def get_generation(chat_id):
+    """Get the chat's running generation, so a reloaded page can rejoin it."""
+    for job in generation_jobs.running(chat_id):
+        _, node_id = job.key
+        return jsonify({"node_id": node_id, "viewers": job.viewers})
+    return jsonify({"error": "No generation running"}), 404
 
-        except Exception as e:
-            yield "data: " + json.dumps(
-                {"type": "error", "content": f"Error: {str(e)}"}
-            ) + "\n\n"
 
-    return Response(generate(), mimetype="text/event-stream")
+@app.route("/api/chats/<chat_id>/stop", methods=["POST"])
+@login_required
+def stop_generation(chat_id):
+    """Stop the chat's running generations, keeping what was written so far."""
+    with chats_lock:
+        running = list(active_generations.get(chat_id, ()))
+    for cancel in running:
+        cancel.set()
+    return jsonify({"success": True, "stopped": len(running)})
 
 
 @app.route("/api/chats/<chat_id>/edit", methods=["POST"])
 @login_required
 def edit_message(chat_id):
     """Edit a message in a specific chat."""
-    if chat_id not in chats:
+    chat = get_request_chat(chat_id)
+    if not chat:
         return jsonify({"error": "Chat not found"}), 404
 
     data = request.json
@@ -696,39 +1878,39 @@ def edit_message(chat_id):
     new_content = data.get("content", "")
     new_files = data.get("files", [])
 
-    chat = chats[chat_id]
-    node = find_node_by_id(chat.tree.root, node_id)
-    if not node:
-        return jsonify({"error": "Node not found"}), 404
+    with chat_lock(chat_id):
+        node = chat.tree.get_node(node_id)
+        if not node:
+            return jsonify({"error": "Node not found"}), 404
 
-    # Create new sibling node with edited content
-    parent_id = node.parent_id
-    if not parent_id:
-        return jsonify({"error": "Cannot edit root node"}), 400
+        # Create new sibling node with edited content
+        parent_id = node.parent_id
+        if not parent_id:
+            return jsonify({"error": "Cannot edit root node"}), 400
 
-    parent_node = find_node_by_id(chat.tree.root, parent_id)
-    if not parent_node:
-        return jsonify({"error": "Parent node not found"}), 404
+        parent_node = node.parent
+        if not parent_node:
+            return jsonify({"error": "Parent node not found"}), 404
 
-    new_message = node.message
-    new_message["content"] = new_content
-    new_message["files"] = new_files
-    new_node = ChatNode(
-        id=str(uuid.uuid4()),
-        role=node.role,
-        content=new_content,
-        message=new_message,
-        files=new_files,
-        parent_id=parent_id,
-    )
+        new_message = dict(node.message)
+        new_message["content"] = new_content
+        new_message["files"] = new_files
+        new_node = ChatNode(
+            id=str(uuid.uuid4()),
+            role=node.role,
+            content=new_content,
+            message=new_message,
+            files=new_files,
+            parent_id=parent_id,
+        )
 
-    parent_node.children.append(new_node)
-    chat.tree.current_node_id = new_node.id
+        chat.tree.add_child(parent_node, new_node)
+        chat.tree.current_node_id = new_node.id
 
-    # Update chat timestamp
-    chat.updated_at = datetime.now()
+        # Update chat timestamp
+        chat.updated_at = datetime.now()
 
-    save_chats()
+        save_chat(chat, new_node)
 
     # Return whether this was a user message (for auto-generation)
     return jsonify(
@@ -744,24 +1926,25 @@ def edit_message(chat_id):
 @login_required
 def continue_message(chat_id, node_id):
     """Continue generating from an existing assistant message."""
-    if chat_id not in chats:
+    chat = get_request_chat(chat_id)
+    if not chat:
         return jsonify({"error": "Chat not found"}), 404
 
-    chat = chats[chat_id]
-    node = find_node_by_id(chat.tree.root, node_id)
-    if not node:
-        return jsonify({"error": "Node not found"}), 404
+    with chat_lock(chat_id):
+        node = chat.tree.get_node(node_id)
+        if not node:
+            return jsonify({"error": "Node not found"}), 404
 
-    if node.role != "assistant":
-        return jsonify({"error": "Can only continue assistant messages"}), 400
+        if node.role != "assistant":
+            return jsonify({"error": "Can only continue assistant messages"}), 400
 
-    # Update current node to this assistant message
-    chat.tree.current_node_id = node_id
+        # Update current node to this assistant message
+        chat.tree.current_node_id = node_id
 
-    # Update chat timestamp
-    chat.updated_at = datetime.now()
+        # Update chat timestamp
+        chat.updated_at = datetime.now()
 
-    save_chats()
+        save_chat(chat)
 
     return jsonify({"success": True, "node_id": node_id})
 
@@ -771,6 +1954,7 @@ def continue_message(chat_id, node_id):
 @login_required
 def upload_file():
     """Upload a file."""
+    global files_version
     if "file" not in request.files:
         return jsonify({"error": "No file provided"}), 400
 
@@ -811,7 +1995,8 @@ def upload_file():
             "is_image": is_image_file({"mime_type": mime_type}),
         }
 
-        save_chats()
+        writer.save_file(file_uuid, global_files[file_uuid])
+        files_version = next(version_counter)
 
         return jsonify(
             {
@@ -828,7 +2013,7 @@ def upload_file():
 @login_required
 def list_files():
     """Get list of all files."""
-    return jsonify(global_files)
+    return conditional_json(f"files-{BOOT_ID}-{files_version}", lambda: global_files)
 
 
 @app.route("/api/files/<file_uuid>")
@@ -864,12 +2049,67 @@ def toggle_tool():
 
     if tool_name in TOOLS:
         enabled_tools[tool_name] = enabled
-        save_chats()
+        writer.save_setting("enabled_tools", enabled_tools)
         return jsonify({"success": True})
 
     return jsonify({"error": "Tool not found"}), 404
 
 
+# Stats routes
+@app.route("/api/stats")
+@login_required
+def get_stats():
+    """Get cache and connection pool statistics."""
+    return jsonify(
+        {
+            "image_cache": image_cache.stats(),
+            "text_cache": text_cache.stats(),
+            "llama_pool": get_pool_stats(),
+            "prompt_cache": prompt_cache_stats.stats(),
+            "scheduler": scheduler.stats(),
+            "generation_jobs": generation_jobs.stats(),
+            "persistence": writer.stats(),
+            "tool_cache": tool_cache.stats(),
+        }
+    )
+
+
+@app.route("/api/traces")
+@login_required
+def list_traces():
+    """Get the timing breakdowns of recent generations, newest first."""
+    return jsonify([recorded.summary() for recorded in traces.recent()])
+
+
+@app.route("/api/traces/<trace_id>")
+@login_required
+def get_trace(trace_id):
+    """Get a generation's spans, or Chrome's trace format with ?format=chrome."""
+    recorded = traces.get(trace_id)
+    if not recorded:
+        return jsonify({"error": "Trace not found"}), 404
+    if request.args.get("format") == "chrome":
+        return jsonify(recorded.to_chrome())
+    return jsonify(recorded.to_json())
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format.
+
+    Open to logged-in users, and to scrapers sending METRICS_TOKEN as a
+    bearer token.
+    """
+    authorization = request.headers.get("Authorization", "")
+    if not session.get("logged_in") and not (
+        METRICS_TOKEN and hmac.compare_digest(authorization, f"Bearer {METRICS_TOKEN}")
+    ):
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     load_chats()
+    # Exit normally on SIGTERM so queued writes are flushed
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     app.run(debug=True, host="0.0.0.0", port=55551)
@@ -0,0 +1,207 @@
+"""ASGI entry point, e.g. ``uvicorn asgi:app --host 0.0.0.0 --port 5555``.
+
+Response streams are served natively: each SSE client is a coroutine
+following its generation job, and each generation runs on the event loop,
+talking to llama-server with an async HTTP client, so neither idle clients
+nor running generations cost a thread. Every other route (all short
+requests) runs the Flask app on a thread pool, with the same URLs, login
+checks and responses as under a WSGI server. Requires an ASGI server and
+httpx, e.g. ``pip install uvicorn httpx``.
+"""
+
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, session
+from werkzeug.test import EnvironBuilder
+from dotenv import load_dotenv
+import app as chat_app
+from LLM import close_async_llama_client
+from tools import close_async_http_client
+
+load_dotenv()
+import os
+
+# Threads for the ordinary (non-streaming) Flask routes
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", 32))
+
+STREAM_PATH = re.compile(r"^/api/chats/([^/]+)/stream/([^/]+)$")
+
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="wsgi")
+
+
+def build_environ(scope, body=b""):
+    """Build a WSGI environ for an ASGI HTTP request."""
+    host, port = scope.get("server") or ("localhost", 80)
+    environ = EnvironBuilder(
+        method=scope["method"],
+        path=scope["path"],
+        base_url=f"{scope.get('scheme', 'http')}://{host}:{port}"
+        + scope.get("root_path", ""),
+        query_string=scope.get("query_string", b"").decode("latin-1"),
+        headers=[
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        ],
+        data=body,
+    ).get_environ()
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    return environ
+
+
+def run_wsgi(environ):
+    """Run the Flask app for one request and collect the whole response."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = chat_app.app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+async def call_flask(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    loop = asyncio.get_running_loop()
+    status, headers, body = await loop.run_in_executor(
+        wsgi_executor, run_wsgi, build_environ(scope, body)
+    )
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def open_stream(scope, loop):
+    """Check a stream request and find its job, like the Flask route does.
+
+    A new job runs on loop. Returns (status, headers, job, after); job is
+    None for non-200 answers.
+    """
+    match = STREAM_PATH.match(scope["path"])
+    environ = build_environ(scope)
+
+    with chat_app.app.request_context(environ):
+        chat_app.app.preprocess_request()
+        if not session.get("logged_in"):
+            return 302, [(b"location", b"/login")], None, 0
+
+        chat_id, node_id = match.groups()
+        if chat_id not in chat_app.chats:
+            return 404, [], None, 0
+
+        last_event_id = environ.get("HTTP_LAST_EVENT_ID")
+        join_only = request.args.get("resume") == "1"
+        job, after = chat_app.open_stream(
+            chat_id, node_id, last_event_id, join_only, loop
+        )
+        if job is None:
+            return 204, [], None, 0
+        return 200, [], job, after
+
+
+async def stream(scope, receive, send):
+    # Checking the session and starting a job may touch the database
+    loop = asyncio.get_running_loop()
+    status, headers, job, after = await loop.run_in_executor(
+        wsgi_executor, open_stream, scope, loop
+    )
+    if job is None:
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8")]
+            + [
+                (name.lower().encode(), value.encode())
+                for name, value in chat_app.SSE_HEADERS.items()
+            ],
+        }
+    )
+
+    async def pump():
+        async for text in job.aevents(after):
+            await send(
+                {"type": "http.response.body", "body": text.encode(), "more_body": True}
+            )
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # Stop following the job as soon as the client goes away
+    tasks = [
+        asyncio.ensure_future(pump()),
+        asyncio.ensure_future(wait_for_disconnect()),
+    ]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        task.result()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.get_running_loop().run_in_executor(
+                wsgi_executor, chat_app.load_chats
+            )
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await close_async_llama_client()
+            await close_async_http_client()
+            # Stop the write-behind thread and write what is still queued
+            await asyncio.get_running_loop().run_in_executor(
+                wsgi_executor, chat_app.writer.close
+            )
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def reject_websocket(receive, send):
+    # Closing before accepting makes the server answer the handshake with 403
+    if (await receive())["type"] == "websocket.connect":
+        await send({"type": "websocket.close"})
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "websocket":
+        await reject_websocket(receive, send)
+    elif scope["type"] != "http":
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+    elif scope["method"] == "GET" and STREAM_PATH.match(scope["path"]):
+        await stream(scope, receive, send)
+    else:
+        await call_flask(scope, receive, send)
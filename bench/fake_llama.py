@@ -0,0 +1,292 @@
+"""A stand-in for llama-server, for benchmarking without a GPU.
+
+Speaks the parts of llama-server's API the app uses: streaming
+/v1/chat/completions (with timings and tool calls), /health, /slots and
+/tokenize. Replies are generated at a fixed token rate after a
+prompt-processing delay, prompts are cached per slot like
+``cache_prompt``, and errors and dropped streams can be injected:
+
+    python bench/fake_llama.py --port 8080 --tokens-per-second 40 --slots 4
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CHARS_PER_TOKEN = 4
+# Tools it may call: ones that run locally, so a benchmark never hits the network
+OFFLINE_TOOLS = ("calculator",)
+WORDS = (
+    "the model streams a reply one token at a time while the benchmark "
+    "measures how long each request waits and how fast the tokens arrive"
+).split()
+
+
+def count_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def calculator_args():
+    return {
+        "num1": random.randint(1, 100),
+        "num2": random.randint(1, 100),
+        "operation": random.choice(["add", "subtract", "multiply", "divide"]),
+    }
+
+
+# --------------------
+# SLOTS
+# --------------------
+class Slots:
+    """Server slots: one request at a time each, remembering its last prompt."""
+
+    def __init__(self, n):
+        self.prompts = [""] * n
+        self.busy = [False] * n
+        self.last_used = [0.0] * n
+        self._cond = threading.Condition()
+
+    def acquire(self, wanted=None):
+        with self._cond:
+            while True:
+                if wanted is not None and 0 <= wanted < len(self.busy):
+                    if not self.busy[wanted]:
+                        slot = wanted
+                        break
+                else:
+                    idle = [i for i, busy in enumerate(self.busy) if not busy]
+                    if idle:
+                        slot = min(idle, key=lambda i: self.last_used[i])
+                        break
+                self._cond.wait()
+            self.busy[slot] = True
+            return slot
+
+    def release(self, slot, prompt):
+        with self._cond:
+            self.busy[slot] = False
+            self.prompts[slot] = prompt
+            self.last_used[slot] = time.monotonic()
+            self._cond.notify_all()
+
+    def to_json(self):
+        with self._cond:
+            return [
+                {"id": i, "is_processing": busy} for i, busy in enumerate(self.busy)
+            ]
+
+
+# --------------------
+# HANDLER
+# --------------------
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+    slots = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/slots"):
+            self.send_json(200, self.slots.to_json())
+        elif self.path.startswith("/health"):
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": {"code": 400, "message": "Bad JSON"}})
+            return
+
+        if self.path.endswith("/tokenize"):
+            tokens = count_tokens(body.get("content", ""))
+            self.send_json(200, {"tokens": list(range(tokens))})
+        elif self.path.endswith("/chat/completions"):
+            self.chat_completion(body)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def chat_completion(self, body):
+        options = self.options
+        if random.random() < options.error_rate:
+            self.send_json(
+                options.error_status,
+                {"error": {"code": options.error_status, "message": "Injected error"}},
+            )
+            return
+
+        prompt = json.dumps(body.get("messages", []))
+        slot = self.slots.acquire(body.get("id_slot"))
+        try:
+            cached = 0
+            if body.get("cache_prompt"):
+                cached = common_prefix(self.slots.prompts[slot], prompt)
+            prompt_n = count_tokens(prompt[cached:])
+            cache_n = cached // CHARS_PER_TOKEN
+
+            # Prompt processing, then the first token
+            prompt_seconds = options.prompt_latency
+            prompt_seconds += prompt_n / options.prompt_tokens_per_second
+            time.sleep(prompt_seconds)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.stream_reply(body, prompt_n, cache_n, prompt_seconds)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stopped reading
+        finally:
+            self.slots.release(slot, prompt)
+
+    def stream_reply(self, body, prompt_n, cache_n, prompt_seconds):
+        options = self.options
+        messages = body.get("messages") or [{}]
+        tools = [
+            tool
+            for tool in body.get("tools") or []
+            if tool["function"]["name"] in OFFLINE_TOOLS
+        ]
+        max_tokens = min(
+            body.get("max_tokens") or options.max_tokens, options.max_tokens
+        )
+        started = time.monotonic()
+        predicted_n = 0
+
+        def timings():
+            elapsed = max(time.monotonic() - started, 1e-6)
+            return {
+                "cache_n": cache_n,
+                "prompt_n": prompt_n,
+                "prompt_ms": prompt_seconds * 1000,
+                "prompt_per_second": prompt_n / max(prompt_seconds, 1e-6),
+                "predicted_n": predicted_n,
+                "predicted_ms": elapsed * 1000,
+                "predicted_per_second": predicted_n / elapsed,
+            }
+
+        def send(data):
+            chunk = f"data: {data}\n\n".encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+
+        def send_delta(delta):
+            chunk = {"choices": [{"index": 0, "delta": delta}]}
+            if body.get("timings_per_token"):
+                chunk["timings"] = timings()
+            send(json.dumps(chunk))
+
+        # Tool calls answer user turns only, so a tool result gets a reply
+        if (
+            tools
+            and messages[-1].get("role") == "user"
+            and random.random() < options.tool_call_rate
+        ):
+            tool = random.choice(tools)
+            predicted_n = 1
+            send_delta(
+                {
+                    "tool_calls": [
+                        {
+                            "index": 0,
+                            "id": f"call_{random.getrandbits(32):08x}",
+                            "type": "function",
+                            "function": {
+                                "name": tool["function"]["name"],
+                                "arguments": json.dumps(calculator_args()),
+                            },
+                        }
+                    ]
+                }
+            )
+        else:
+            for i in range(max_tokens):
+                if i and random.random() < options.disconnect_rate / max_tokens:
+                    # Drop the connection mid-stream, like a crashed server
+                    self.close_connection = True
+                    return
+                time.sleep(1 / options.tokens_per_second)
+                predicted_n += 1
+                send_delta({"content": random.choice(WORDS) + " "})
+
+        final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        final["timings"] = timings()
+        send(json.dumps(final))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--slots", type=int, default=4, help="parallel requests")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--max-tokens", type=int, default=128, help="reply length")
+    parser.add_argument(
+        "--prompt-tokens-per-second",
+        type=float,
+        default=2000,
+        help="prompt processing speed for uncached tokens",
+    )
+    parser.add_argument(
+        "--prompt-latency", type=float, default=0.0, help="extra seconds per request"
+    )
+    parser.add_argument(
+        "--tool-call-rate",
+        type=float,
+        default=0.0,
+        help="chance a user turn is answered with a calculator call",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="chance a request fails"
+    )
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument(
+        "--disconnect-rate",
+        type=float,
+        default=0.0,
+        help="chance a reply is cut off mid-stream",
+    )
+    parser.add_argument("--seed", type=int)
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    Handler.options = options
+    Handler.slots = Slots(options.slots)
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    print(f"Fake llama-server on http://{options.host}:{options.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""Load test the app against the fake llama-server.
+
+Starts bench/fake_llama.py and the app (or uses running ones), then has N
+simulated users each hold a deep chat: they send messages, sometimes edit
+an earlier message to branch the chat, and read every response stream to
+the end. Prints a JSON report with throughput, time to first token and
+latency percentiles, for comparing runs:
+
+    python bench/run.py --users 16 --turns 8 --output results.json
+    python bench/run.py --server uvicorn --env MAX_ACTIVE_GENERATIONS=8
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "bench"
+# Tools that reach the internet; turned off in apps the benchmark starts
+NETWORK_TOOLS = ("web_search", "read_url")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": values[-1],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --------------------
+# SERVERS
+# --------------------
+def start_fake_llama(options, port):
+    command = [
+        sys.executable,
+        os.path.join(ROOT, "bench", "fake_llama.py"),
+        "--port",
+        str(port),
+        "--slots",
+        str(options.slots),
+        "--tokens-per-second",
+        str(options.tokens_per_second),
+        "--max-tokens",
+        str(options.max_tokens),
+        "--tool-call-rate",
+        str(options.tool_call_rate),
+        "--error-rate",
+        str(options.error_rate),
+        "--disconnect-rate",
+        str(options.disconnect_rate),
+        "--prompt-latency",
+        str(options.prompt_latency),
+        "--prompt-tokens-per-second",
+        str(options.prompt_tokens_per_second),
+        "--seed",
+        str(options.seed),
+    ]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+
+def start_app(options, port, llama_url, workdir):
+    env = dict(
+        os.environ,
+        LLAMA_URL=llama_url,
+        APP_PASSWORD=PASSWORD,
+        FLASK_SECRET_KEY=os.urandom(16).hex(),
+        PYTHONPATH=ROOT,
+    )
+    env.update(item.split("=", 1) for item in options.env)
+    address = f"127.0.0.1:{port}"
+    if options.server == "flask":
+        command = ["flask", "--app", "wsgi", "run", "--port", str(port)]
+    elif options.server == "uvicorn":
+        command = ["uvicorn", "asgi:app", "--port", str(port)]
+        command += ["--log-level", "warning"]
+    else:
+        env.setdefault("APP_WORKERS", str(options.workers))
+        command = ["gunicorn", "-w", str(options.workers), "-k", "gthread"]
+        command += ["--threads", "32", "-b", address, "wsgi:app"]
+    return subprocess.Popen(
+        [sys.executable, "-m"] + command,
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def disable_network_tools(app_url, password):
+    session = requests.Session()
+    session.post(f"{app_url}/login", data={"password": password})
+    for tool_name in NETWORK_TOOLS:
+        resp = session.post(
+            f"{app_url}/api/tools/toggle",
+            json={"tool_name": tool_name, "enabled": False},
+        )
+        resp.raise_for_status()
+
+
+# --------------------
+# SIMULATED USERS
+# --------------------
+def read_stream(session, url):
+    """Read a response stream to the end and get (first token time, chars, error)."""
+    first_token = None
+    chars = 0
+    with session.get(url, stream=True, timeout=(5, 300)) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            kind = event.get("type")
+            if kind == "finished":
+                return first_token, chars, None
+            if kind == "error":
+                return first_token, chars, event.get("content")
+            if kind == "content":
+                text = event["content"]
+            elif "choices" in event:
+                # LLAMA_SSE_PASSTHROUGH forwards upstream chunks as they are
+                delta = (event["choices"] or [{}])[0].get("delta", {})
+                text = delta.get("content") or ""
+            else:
+                continue
+            if text and first_token is None:
+                first_token = time.perf_counter()
+            chars += len(text)
+    return first_token, chars, "Stream ended without a finished event"
+
+
+def simulate_user(options, app_url, seed, results):
+    rng = random.Random(seed)
+    session = requests.Session()
+    session.post(f"{app_url}/login", data={"password": options.password})
+    resp = session.post(f"{app_url}/api/chats/new")
+    resp.raise_for_status()
+    chat_id = resp.json()["chat_id"]
+    user_nodes = []
+
+    for turn in range(options.turns):
+        message = f"Turn {turn}: " + " ".join(
+            rng.choice(["explain", "the", "plan", "in", "detail", "please"])
+            for _ in range(options.message_words)
+        )
+        branch = bool(user_nodes) and rng.random() < options.branch_rate
+        started = time.perf_counter()
+        try:
+            if branch:
+                resp = session.post(
+                    f"{app_url}/api/chats/{chat_id}/edit",
+                    json={
+                        "node_id": rng.choice(user_nodes),
+                        "content": message,
+                        "files": [],
+                    },
+                )
+            else:
+                resp = session.post(
+                    f"{app_url}/api/chats/{chat_id}/send",
+                    json={"message": message, "files": []},
+                )
+            resp.raise_for_status()
+            node_id = resp.json()["node_id"]
+            user_nodes.append(node_id)
+            first_token, chars, error = read_stream(
+                session, f"{app_url}/api/chats/{chat_id}/stream/{node_id}"
+            )
+        except (requests.RequestException, ValueError, KeyError) as e:
+            first_token, chars, error = None, 0, str(e)
+        finished = time.perf_counter()
+
+        results.append(
+            {
+                "kind": "edit" if branch else "send",
+                "error": error,
+                "ttft": first_token - started if first_token else None,
+                "latency": finished - started,
+                "chars": chars,
+            }
+        )
+
+
+def run(options, app_url):
+    results = []
+    threads = [
+        threading.Thread(
+            target=simulate_user,
+            args=(options, app_url, options.seed + i, results),
+            daemon=True,
+        )
+        for i in range(options.users)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    ok = [result for result in results if not result["error"]]
+    errors = {}
+    for result in results:
+        if result["error"]:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    return {
+        "duration": duration,
+        "turns": len(results),
+        "failed": len(results) - len(ok),
+        "errors": errors,
+        "turns_per_second": len(ok) / duration,
+        "chars_per_second": sum(result["chars"] for result in ok) / duration,
+        "ttft": percentiles([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "latency": percentiles([result["latency"] for result in ok]),
+        "branches": sum(1 for result in results if result["kind"] == "edit"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=8, help="concurrent users")
+    parser.add_argument("--turns", type=int, default=6, help="messages per user")
+    parser.add_argument(
+        "--branch-rate",
+        type=float,
+        default=0.2,
+        help="chance a turn edits an earlier message instead of sending",
+    )
+    parser.add_argument("--message-words", type=int, default=40)
+    parser.add_argument(
+        "--server",
+        choices=["flask", "uvicorn", "gunicorn"],
+        default="flask",
+        help="how to serve the app (gunicorn and uvicorn must be installed)",
+    )
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra environment for the app, e.g. MAX_ACTIVE_GENERATIONS=8",
+    )
+    parser.add_argument("--app-url", help="benchmark an already running app")
+    parser.add_argument("--password", default=PASSWORD, help="with --app-url")
+    parser.add_argument("--llama-url", help="use this llama-server instead")
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--tool-call-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--disconnect-rate",
+        type=float,
+        default=0.0,
+        help="chance the fake server cuts a reply off mid-stream",
+    )
+    parser.add_argument(
+        "--prompt-latency",
+        type=float,
+        default=0.0,
+        help="extra seconds of prompt processing per request",
+    )
+    parser.add_argument(
+        "--prompt-tokens-per-second",
+        type=float,
+        default=2000,
+        help="prompt processing speed for uncached tokens",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", help="name for this run in the report")
+    parser.add_argument("--output", help="write the JSON report here")
+    options = parser.parse_args()
+
+    processes = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+            app_url = options.app_url
+            if not app_url:
+                llama_url = options.llama_url
+                if not llama_url:
+                    port = free_port()
+                    processes.append(start_fake_llama(options, port))
+                    wait_until_up(f"http://127.0.0.1:{port}/health", processes[-1])
+                    llama_url = f"http://127.0.0.1:{port}/v1/chat/completions"
+                port = free_port()
+                processes.append(start_app(options, port, llama_url, workdir))
+                app_url = f"http://127.0.0.1:{port}"
+                wait_until_up(f"{app_url}/login", processes[-1])
+                disable_network_tools(app_url, options.password)
+
+            results = run(options, app_url)
+
+            session = requests.Session()
+            session.post(f"{app_url}/login", data={"password": options.password})
+            try:
+                stats = session.get(f"{app_url}/api/stats", timeout=10).json()
+            except (requests.RequestException, ValueError):
+                stats = None
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "label": options.label,
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            name: value
+            for name, value in vars(options).items()
+            if name not in ("output", "label", "password")
+        },
+        "results": results,
+        "app_stats": stats,
+    }
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import copy
+import hashlib
+import json
+import math
+import re
+import time
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from dotenv import load_dotenv
+from cache import LRUCache
+from LLM import llama_session, LLAMA_URL, LLAMA_CONNECT_TIMEOUT
+
+load_dotenv()
+import os
+
+# Prompt token budget; 0 sends the full history unchanged
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 0))
+# Strategies applied in order until the prompt fits
+CONTEXT_STRATEGIES = os.getenv(
+    "CONTEXT_STRATEGIES", "truncate_tool_outputs,summarize,drop_oldest_turns"
+)
+LLAMA_TOKENIZE_URL = os.getenv("LLAMA_TOKENIZE_URL")
+TOKEN_CACHE_ENTRIES = int(os.getenv("TOKEN_CACHE_ENTRIES", 50000))
+# Tokens kept from each tool output when truncating
+TOOL_OUTPUT_TOKENS = int(os.getenv("TOOL_OUTPUT_TOKENS", 1000))
+# Messages longer than this are candidates for summaries
+SUMMARY_MIN_TOKENS = int(os.getenv("SUMMARY_MIN_TOKENS", 500))
+
+# Rough per-message overhead of the chat template, and cost of an image
+MESSAGE_OVERHEAD_TOKENS = 4
+IMAGE_TOKENS = 768
+CHARS_PER_TOKEN = 4
+
+
+def tokenize_url_from(chat_url):
+    """Derive llama-server's /tokenize URL from its chat completions URL."""
+    if not chat_url:
+        return None
+    parts = urlsplit(chat_url)
+    return urlunsplit((parts.scheme, parts.netloc, "/tokenize", "", ""))
+
+
+# --------------------
+# TOKEN COUNTING
+# --------------------
+class TokenCounter:
+    """Counts tokens with llama-server's /tokenize endpoint, caching by content.
+
+    Falls back to a characters-per-token estimate when the server can't be
+    reached, and stops asking it for a while after a failure.
+    """
+
+    def __init__(self, url, max_entries, retry_after=30):
+        self.url = url
+        self.retry_after = retry_after
+        self.cache = LRUCache(max_entries, sizeof=lambda _: 1)
+        self._down_until = 0
+
+    def count_text(self, text):
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = self._tokenize(text)
+            if tokens is None:
+                return math.ceil(len(text) / CHARS_PER_TOKEN)
+            self.cache.put(key, tokens)
+        return tokens
+
+    def count_message(self, message):
+        tokens = MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += self.count_text(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    tokens += IMAGE_TOKENS
+                else:
+                    tokens += self.count_text(part.get("text", ""))
+        for tool_call in message.get("tool_calls") or []:
+            tokens += self.count_text(json.dumps(tool_call.get("function", {})))
+        return tokens
+
+    def _tokenize(self, text):
+        if not self.url or time.monotonic() < self._down_until:
+            return None
+        try:
+            resp = llama_session.post(
+                self.url,
+                json={"content": text},
+                timeout=(LLAMA_CONNECT_TIMEOUT, 10),
+            )
+            resp.raise_for_status()
+            return len(resp.json()["tokens"])
+        except (requests.RequestException, KeyError, ValueError):
+            self._down_until = time.monotonic() + self.retry_after
+            return None
+
+
+# --------------------
+# STRATEGIES
+# --------------------
+# Each strategy takes (messages, counter, budget, protected) and shortens
+# messages in place. protected is the index of the first message strategies
+# must keep verbatim (the latest user turn onwards). Only if the prompt still
+# doesn't fit does ContextBuilder.fit cut the tool outputs in it, to what the
+# budget leaves after every other message.
+def total_tokens(messages, counter):
+    return sum(counter.count_message(message) for message in messages)
+
+
+def cut_text(text, max_tokens, counter):
+    """Cut text down to about max_tokens, noting how much was removed."""
+    if counter.count_text(text) <= max_tokens:
+        return text
+    note = f"\n[... {len(text)} characters truncated ...]"
+    max_tokens = max(max_tokens - counter.count_text(note), 0)
+    chars = max_tokens * CHARS_PER_TOKEN
+    # The count may not match the estimate; shrink until it fits
+    for _ in range(3):
+        tokens = counter.count_text(text[:chars])
+        if tokens <= max_tokens:
+            break
+        chars = chars * max_tokens // tokens
+    removed = len(text) - chars
+    return text[:chars] + f"\n[... {removed} characters truncated ...]"
+
+
+def cut_tool_output(message, max_tokens, counter):
+    """Cut a tool message's output to max_tokens; get the tokens saved."""
+    before = counter.count_message(message)
+    message["content"] = cut_text(message["content"], max(max_tokens, 0), counter)
+    return before - counter.count_message(message)
+
+
+def is_tool_output(message):
+    return message.get("role") == "tool" and isinstance(message.get("content"), str)
+
+
+def truncate_tool_outputs(messages, counter, budget, protected):
+    """Cut older tool outputs, oldest first, to TOOL_OUTPUT_TOKENS each.
+
+    An output is cut further if that is what the budget takes.
+    """
+    total = total_tokens(messages, counter)
+    for message in messages[:protected]:
+        if total <= budget:
+            break
+        if not is_tool_output(message):
+            continue
+        tokens = counter.count_text(message["content"])
+        max_tokens = min(TOOL_OUTPUT_TOKENS, tokens - (total - budget))
+        if tokens > max_tokens:
+            total -= cut_tool_output(message, max_tokens, counter)
+
+
+def extractive_summary(text, max_chars=SUMMARY_MIN_TOKENS * CHARS_PER_TOKEN // 2):
+    """Default summarizer: keep the opening and closing sentences of a text."""
+    sentences = re.split(r"(?<=[.!?])\s+", text.strip())
+    head, tail = [], []
+    head_chars = tail_chars = 0
+    for sentence in sentences:
+        if head_chars + len(sentence) > max_chars // 2:
+            break
+        head.append(sentence)
+        head_chars += len(sentence)
+    for sentence in reversed(sentences[len(head) :]):
+        if tail_chars + len(sentence) > max_chars // 2:
+            break
+        tail.insert(0, sentence)
+        tail_chars += len(sentence)
+    if not head and not tail:
+        return text[:max_chars]
+    return " ".join(head) + " [...] " + " ".join(tail)
+
+
+class SummaryStore:
+    """Cached summaries of long messages, keyed by their content.
+
+    summarize can be swapped for a model-backed summarizer.
+    """
+
+    def __init__(self, summarize=extractive_summary, max_entries=1000):
+        self.summarize = summarize
+        self.cache = LRUCache(max_entries, sizeof=lambda _: 1)
+
+    def get(self, text):
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        summary = self.cache.get(key)
+        if summary is None:
+            summary = self.summarize(text)
+            self.cache.put(key, summary)
+        return summary
+
+
+summaries = SummaryStore()
+
+
+def summarize(messages, counter, budget, protected):
+    """Replace long older text (including attachments) with cached summaries."""
+    total = total_tokens(messages, counter)
+    for message in messages[:protected]:
+        if total <= budget:
+            break
+        content = message.get("content")
+        if message.get("role") == "system":
+            continue
+
+        before = counter.count_message(message)
+        if isinstance(content, str):
+            if counter.count_text(content) > SUMMARY_MIN_TOKENS:
+                message["content"] = "[Summary] " + summaries.get(content)
+        elif isinstance(content, list):
+            for part in content:
+                text = part.get("text") if part.get("type") == "text" else None
+                if text and counter.count_text(text) > SUMMARY_MIN_TOKENS:
+                    part["text"] = "[Summary] " + summaries.get(text)
+        total += counter.count_message(message) - before
+
+
+def drop_oldest_turns(messages, counter, budget, protected):
+    """Drop whole turns (a user message and its replies), oldest first."""
+    start = 1 if messages and messages[0].get("role") == "system" else 0
+    total = total_tokens(messages, counter)
+    while total > budget and start < protected:
+        # A turn runs until the next user message
+        end = start + 1
+        while end < protected and messages[end].get("role") != "user":
+            end += 1
+        total -= total_tokens(messages[start:end], counter)
+        del messages[start:end]
+        protected -= end - start
+
+
+STRATEGIES = {
+    "truncate_tool_outputs": truncate_tool_outputs,
+    "summarize": summarize,
+    "drop_oldest_turns": drop_oldest_turns,
+}
+
+
+# --------------------
+# CONTEXT BUILDER
+# --------------------
+class ContextBuilder:
+    """Fits a conversation into a prompt token budget."""
+
+    def __init__(self, budget, counter, strategies):
+        self.budget = budget
+        self.counter = counter
+        self.strategies = strategies
+
+    def fit(self, messages):
+        """Get a copy of messages that fits the budget (best effort).
+
+        The system prompt and the latest user turn are always kept; the tool
+        outputs of that turn are cut last. A prompt that still doesn't fit
+        is logged and returned as it is.
+        """
+        if not self.budget or total_tokens(messages, self.counter) <= self.budget:
+            return messages
+
+        messages = copy.deepcopy(messages)
+        protected = max(
+            (i for i, message in enumerate(messages) if message.get("role") == "user"),
+            default=len(messages),
+        )
+        for strategy in self.strategies:
+            if total_tokens(messages, self.counter) <= self.budget:
+                break
+            before = len(messages)
+            strategy(messages, self.counter, self.budget, protected)
+            protected -= before - len(messages)
+
+        total = total_tokens(messages, self.counter)
+        if total > self.budget:
+            total = self.cut_latest_tool_outputs(messages, protected, total)
+        if total > self.budget:
+            print(f"Prompt is {total} tokens, over the budget of {self.budget}")
+        return messages
+
+    def cut_latest_tool_outputs(self, messages, protected, total):
+        """Share what the budget leaves among the latest turn's tool outputs.
+
+        Returns the new token total.
+        """
+        outputs = [
+            message for message in messages[protected:] if is_tool_output(message)
+        ]
+        if not outputs:
+            return total
+        sizes = [self.counter.count_text(message["content"]) for message in outputs]
+        left = self.budget - (total - sum(sizes))
+        # Short outputs keep all of theirs; the rest split what remains evenly
+        for n, (message, tokens) in enumerate(
+            sorted(zip(outputs, sizes), key=lambda pair: pair[1])
+        ):
+            share = max(left // (len(outputs) - n), 0)
+            if tokens > share:
+                total -= cut_tool_output(message, share, self.counter)
+                tokens = share
+            left -= tokens
+        return total
+
+
+context_builder = ContextBuilder(
+    CONTEXT_TOKEN_BUDGET,
+    TokenCounter(
+        LLAMA_TOKENIZE_URL or tokenize_url_from(LLAMA_URL), TOKEN_CACHE_ENTRIES
+    ),
+    [STRATEGIES[name.strip()] for name in CONTEXT_STRATEGIES.split(",") if name],
+)
@@ -0,0 +1,282 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from dotenv import load_dotenv
+
+load_dotenv()
+import os
+
+# Events kept per generation for viewers that reconnect
+JOB_BUFFER_EVENTS = int(os.getenv("JOB_BUFFER_EVENTS", 10000))
+# Seconds a finished generation stays available for reconnecting viewers
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 60))
+# Seconds a generation keeps running with nobody watching before it stops
+JOB_ORPHAN_GRACE = float(os.getenv("JOB_ORPHAN_GRACE", 30))
+# Seconds between keep-alive comments on an idle stream
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", 15))
+
+
+# --------------------
+# GENERATION JOBS
+# --------------------
+class CancelEvent(threading.Event):
+    """A threading.Event that also runs callbacks when it is set.
+
+    Lets code blocked on something other than the event (a socket read, a
+    tool's future) be interrupted as soon as a generation is stopped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """Run callback() once the event is set (at once if it already is).
+
+        Returns a function that unregisters the callback.
+        """
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def set(self):
+        with self._callbacks_lock:
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class GenerationJob:
+    """A generation running in the background, decoupled from any request.
+
+    run(cancel) yields the job's SSE strings. It is a generator driven by a
+    thread of its own, or, when the job is given an event loop, an async
+    generator driven by a task on that loop. The strings are numbered and
+    kept in a bounded buffer. Any number of viewers can follow the job,
+    each starting after the last event id it has seen, either from a thread
+    (events) or a coroutine (aevents); a job on an event loop must be
+    followed from that loop. The cancel event is set when the job has had
+    no viewers for the orphan grace period.
+    """
+
+    def __init__(self, key, run, max_events, orphan_grace, loop=None):
+        self.key = key
+        self.loop = loop
+        self.cancel = CancelEvent()
+        self.done = False
+        self.finished_at = None
+        self.viewers = 0
+        self.orphan_grace = orphan_grace
+        self._run = run
+        self._events = deque(maxlen=max_events)  # (id, sse text)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self._async_waiters = set()  # (event loop, asyncio.Event)
+        self._orphan_timer = None
+
+    def start(self):
+        if self.loop is None:
+            threading.Thread(target=self._drive, name="generation", daemon=True).start()
+        else:
+            asyncio.run_coroutine_threadsafe(self._adrive(), self.loop)
+
+    def _drive(self):
+        try:
+            for text in self._run(self.cancel):
+                self._add(text)
+        finally:
+            self._finish()
+
+    async def _adrive(self):
+        try:
+            async for text in self._run(self.cancel):
+                self._add(text)
+        finally:
+            self._finish()
+
+    def _add(self, text):
+        with self._cond:
+            self._last_id += 1
+            self._events.append((self._last_id, text))
+            self._notify()
+
+    def _finish(self):
+        with self._cond:
+            self.done = True
+            self.finished_at = time.monotonic()
+            if self._orphan_timer is not None:
+                self._orphan_timer.cancel()
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, wakeup in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass  # the viewer's event loop has closed
+
+    def events(self, after=0):
+        """Yield SSE text with ids for every event after the given id."""
+        self._attach()
+        try:
+            next_id = after + 1
+            while True:
+                with self._cond:
+                    if next_id > self._last_id and not self.done:
+                        self._cond.wait(SSE_KEEPALIVE)
+                    batch, finished = self._read(next_id)
+                yield from batch
+                if finished:
+                    return
+                if not batch:
+                    yield ": keep-alive\n\n"
+                next_id += len(batch)
+        finally:
+            self._detach()
+
+    async def aevents(self, after=0):
+        """Like events, but waits for new events without blocking a thread."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._attach(waiter)
+        try:
+            next_id = after + 1
+            while True:
+                # Clear before reading so an event added meanwhile wakes us
+                waiter[1].clear()
+                with self._cond:
+                    batch, finished = self._read(next_id)
+                for text in batch:
+                    yield text
+                if finished:
+                    return
+                if batch:
+                    next_id += len(batch)
+                    continue
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            self._detach(waiter)
+
+    def _read(self, next_id):
+        """Get (SSE texts from next_id on, whether the stream should end).
+
+        Call with the condition held. Once the job is done the batch holds
+        everything left. A viewer that fell further behind than the buffer
+        reaches gets a final error event instead.
+        """
+        oldest = self._events[0][0] if self._events else next_id
+        if next_id < oldest:
+            missed = (
+                'data: {"type": "error", "content": "Missed part of the '
+                'response; reload the chat once it finishes"}\n\n'
+            )
+            return [missed], True
+        batch = [
+            f"id: {event_id}\n{text}"
+            for event_id, text in self._events
+            if event_id >= next_id
+        ]
+        return batch, self.done
+
+    def _attach(self, async_waiter=None):
+        with self._cond:
+            self.viewers += 1
+            if async_waiter is not None:
+                self._async_waiters.add(async_waiter)
+            if self._orphan_timer is not None:
+                self._orphan_timer.cancel()
+                self._orphan_timer = None
+
+    def _detach(self, async_waiter=None):
+        with self._cond:
+            self._async_waiters.discard(async_waiter)
+            self.viewers -= 1
+            if self.viewers == 0 and not self.done:
+                if self.loop is None:
+                    self._orphan_timer = threading.Timer(
+                        self.orphan_grace, self._cancel_if_orphaned
+                    )
+                    self._orphan_timer.daemon = True
+                    self._orphan_timer.start()
+                else:
+                    # Viewers of a job on an event loop detach on that loop
+                    self._orphan_timer = self.loop.call_later(
+                        self.orphan_grace, self._cancel_if_orphaned
+                    )
+
+    def _cancel_if_orphaned(self):
+        with self._cond:
+            if self.viewers == 0:
+                self.cancel.set()
+
+
+class JobRegistry:
+    """Running and recently finished generation jobs, by (chat id, node id)."""
+
+    def __init__(self, max_events, retention, orphan_grace):
+        self.max_events = max_events
+        self.retention = retention
+        self.orphan_grace = orphan_grace
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(key)
+
+    def start(self, key, run, loop=None):
+        """Get the running job for key, or start run(cancel) as a new one.
+
+        With an event loop, run is an async generator function and the new
+        job runs on that loop. A finished job is replaced, so asking again
+        generates again.
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(key)
+            if job is None or job.done:
+                job = GenerationJob(key, run, self.max_events, self.orphan_grace, loop)
+                self._jobs[key] = job
+                job.start()
+            return job
+
+    def running(self, chat_id):
+        """Get the running jobs of a chat."""
+        with self._lock:
+            return [
+                job
+                for (job_chat_id, _), job in self._jobs.items()
+                if job_chat_id == chat_id and not job.done
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": sum(1 for job in self._jobs.values() if not job.done),
+                "retained": sum(1 for job in self._jobs.values() if job.done),
+                "viewers": sum(job.viewers for job in self._jobs.values()),
+            }
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if job.done and now - job.finished_at > self.retention:
+                del self._jobs[key]
+
+
+generation_jobs = JobRegistry(JOB_BUFFER_EVENTS, JOB_RETENTION, JOB_ORPHAN_GRACE)
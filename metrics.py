@@ -0,0 +1,172 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(v)}"' for name, v in pairs) + "}"
+
+
+# --------------------
+# METRIC TYPES
+# --------------------
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name + format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, optionally by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # label values -> (bucket counts, sum, count)
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in a with block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(c), s, n) for key, (c, s, n) in self._values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = format_labels(
+                    self.labelnames, key, [("le", format_value(float(bound)))]
+                )
+                yield self.name + "_bucket" + labels, bucket_count
+            labels = format_labels(self.labelnames, key)
+            yield self.name + "_sum" + labels, total
+            yield self.name + "_count" + labels, count
+
+
+class Gauge:
+    """A value read when scraped from read(), e.g. a queue length.
+
+    With labelnames, read() returns a dict of label value (or tuple of
+    values) -> number.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, read, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if not self.labelnames:
+            yield self.name, value
+            return
+        for key, item in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            yield self.name + format_labels(self.labelnames, key), item
+
+
+# --------------------
+# REGISTRY
+# --------------------
+class Registry:
+    """Named metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        return self.register(Histogram(name, help, buckets, labelnames))
+
+    def gauge(self, name, help, read, labelnames=()):
+        return self.register(Gauge(name, help, read, labelnames))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # One failing gauge shouldn't take down the whole scrape
+                lines.append(f"# error reading {metric.name}: {e}")
+                continue
+            for sample, value in samples:
+                lines.append(f"{sample} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+
+load_dotenv()
+import os
+
+# Generations allowed to run against the model at once; 0 means unlimited
+MAX_ACTIVE_GENERATIONS = int(os.getenv("MAX_ACTIVE_GENERATIONS", 4))
+# Seconds a request may wait in the queue before it is turned away
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 120))
+
+
+class QueueTimeout(Exception):
+    """Raised when a request waited longer than the queue allows."""
+
+
+# --------------------
+# FAIR SCHEDULER
+# --------------------
+class Ticket:
+    def __init__(self, key):
+        self.key = key
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+        self.event = threading.Event()
+        # Called once the ticket is granted, for waiters that aren't threads
+        self.on_grant = None
+
+
+class FairScheduler:
+    """Admission control for generations with a round-robin waiting queue.
+
+    At most max_active tickets are granted at once. Waiting tickets are
+    grouped by key (a chat id) and granted one key at a time in rotation, so
+    a chat with many queued requests can't starve the others.
+    """
+
+    def __init__(self, max_active, max_wait, poll_interval=1.0):
+        self.max_active = max_active
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self._queues = OrderedDict()  # key -> deque of tickets, in rotation order
+        self._lock = threading.Lock()
+
+    def enqueue(self, key):
+        ticket = Ticket(key)
+        with self._lock:
+            self._queues.setdefault(key, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def wait(self, ticket, cancel=None):
+        """Block until the ticket is granted, yielding its queue position.
+
+        A position is yielded whenever it changes. Raises QueueTimeout (and
+        gives up the ticket) after max_wait seconds, and returns early without
+        a grant once cancel is set.
+        """
+        last_position = None
+        deadline = ticket.enqueued_at + self.max_wait
+        while not ticket.event.wait(self.poll_interval):
+            if cancel is not None and cancel.is_set():
+                return
+            if self.max_wait and time.monotonic() >= deadline:
+                with self._lock:
+                    if not ticket.granted:
+                        self._remove(ticket)
+                        self.shed += 1
+                        raise QueueTimeout("Server is busy, please try again later")
+                break
+            position = self.position(ticket)
+            if position is not None and position != last_position:
+                last_position = position
+                yield position
+
+    async def await_grant(self, ticket, cancel=None):
+        """Like wait, but for a coroutine: no thread is blocked while queued.
+
+        cancel must be a jobs.CancelEvent so setting it wakes the waiter.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(wakeup.set)
+
+        ticket.on_grant = wake
+        unregister = cancel.add_callback(wake) if cancel is not None else None
+        try:
+            last_position = None
+            deadline = ticket.enqueued_at + self.max_wait
+            while not ticket.event.is_set():
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+                if ticket.event.is_set():
+                    return
+                if cancel is not None and cancel.is_set():
+                    return
+                if self.max_wait and time.monotonic() >= deadline:
+                    with self._lock:
+                        if not ticket.granted:
+                            self._remove(ticket)
+                            self.shed += 1
+                            raise QueueTimeout("Server is busy, please try again later")
+                    return
+                position = self.position(ticket)
+                if position is not None and position != last_position:
+                    last_position = position
+                    yield position
+        finally:
+            ticket.on_grant = None
+            if unregister:
+                unregister()
+
+    def release(self, ticket):
+        """Give up a ticket, whether it was granted or is still waiting."""
+        with self._lock:
+            if ticket.granted:
+                ticket.granted = False
+                self.active -= 1
+            else:
+                self._remove(ticket)
+            self._dispatch()
+
+    def position(self, ticket):
+        """1-based place of a waiting ticket in grant order (None if granted)."""
+        with self._lock:
+            if ticket.granted:
+                return None
+            queues = list(self._queues.values())
+            for rank, queue in enumerate(queues):
+                if ticket in queue:
+                    depth = queue.index(ticket)
+                    # Each earlier round grants one ticket from every key
+                    ahead = sum(min(len(q), depth) for q in queues)
+                    ahead += sum(1 for q in queues[:rank] if len(q) > depth)
+                    return ahead + 1
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_active": self.max_active,
+                "active": self.active,
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "avg_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            }
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.key)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.key]
+
+    def _dispatch(self):
+        while self._queues and (not self.max_active or self.active < self.max_active):
+            key, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            ticket.granted = True
+            self.active += 1
+            self.admitted += 1
+            self.total_wait += time.monotonic() - ticket.enqueued_at
+            ticket.event.set()
+            if ticket.on_grant is not None:
+                ticket.on_grant()
+
+
+scheduler = FairScheduler(MAX_ACTIVE_GENERATIONS, QUEUE_TIMEOUT)
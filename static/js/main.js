@@ -8,6 +8,7 @@ let isStreaming = false;
 let currentEventSource = null;
 let autoScrollEnabled = true;
 let userHasScrolled = false;
+const etagCache = {}; // url -> { etag, data }
 
 
 // Initialize
@@ -50,7 +51,7 @@ function setupEventListeners() {
     document.getElementById('send-btn').addEventListener('click', sendMessage);
 
     // Stop button
-    document.getElementById('stop-btn').addEventListener('click', stopGeneration);
+    document.getElementById('stop-btn').addEventListener('click', requestStop);
 
     // Enter key to send (Shift+Enter for new line)
     document.getElementById('message-input').addEventListener('keydown', function (e) {
@@ -98,6 +99,24 @@ function scrollToBottom() {
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
 
+async function requestStop() {
+    // Ask the server to stop; it saves the partial reply and ends the stream
+    // with 'finished'. Fall back to dropping the stream if that doesn't work.
+    if (!isStreaming) return;
+    const eventSource = currentEventSource;
+    setStatus('Stopping...');
+    try {
+        const response = await fetch(`/api/chats/${currentChatId}/stop`, { method: 'POST' });
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        setTimeout(() => {
+            if (currentEventSource === eventSource) stopGeneration();
+        }, 5000);
+    } catch (error) {
+        console.error('Error stopping generation:', error);
+        stopGeneration();
+    }
+}
+
 function stopGeneration() {
     if (currentEventSource) {
         currentEventSource.close();
@@ -119,6 +138,25 @@ function stopGeneration() {
     indicators.forEach(indicator => indicator.remove());
 }
 
+async function fetchJSON(url) {
+    // GET with If-None-Match; a 304 reuses the body cached for this URL
+    const cached = etagCache[url];
+    const response = await fetch(url, {
+        cache: 'no-store',
+        headers: cached ? { 'If-None-Match': cached.etag } : {}
+    });
+    if (response.status === 304 && cached) {
+        return cached.data;
+    }
+
+    const data = await response.json();
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) {
+        etagCache[url] = { etag, data };
+    }
+    return data;
+}
+
 async function loadTools() {
     try {
         const response = await fetch('/api/tools');
@@ -156,8 +194,7 @@ async function toggleTool(toolName, enabled) {
 
 async function loadFiles() {
     try {
-        const response = await fetch('/api/files');
-        allFiles = await response.json();
+        allFiles = await fetchJSON('/api/files');
 
         const filesList = document.getElementById('files-list');
         filesList.innerHTML = '';
@@ -178,8 +215,7 @@ async function loadFiles() {
 
 async function loadChatList() {
     try {
-        const response = await fetch('/api/chats');
-        const chats = await response.json();
+        const chats = await fetchJSON('/api/chats');
 
         const chatList = document.getElementById('chat-list');
         chatList.innerHTML = '';
@@ -234,8 +270,7 @@ async function switchToChat(chatId) {
     try {
         currentChatId = chatId;
 
-        const response = await fetch(`/api/chats/${chatId}/tree`);
-        const data = await response.json();
+        const data = await fetchJSON(`/api/chats/${chatId}/path`);
 
         currentNodeId = data.current_node_id;
         document.getElementById('chat-title').textContent = data.title;
@@ -244,7 +279,16 @@ async function switchToChat(chatId) {
         currentFiles = [];
         updateCurrentFilesDisplay();
 
-        renderChatHistory(data.tree.root);
+        // Rejoin a response that is still being generated (e.g. after a reload)
+        const generation = isStreaming ? null : await getRunningGeneration(chatId);
+        if (generation) {
+            const end = data.path.findIndex(node => node.id === generation.node_id);
+            const path = end >= 0 ? data.path.slice(0, end + 1) : data.path;
+            renderChatHistory(path);
+            resumeGeneration(path[path.length - 1]);
+        } else {
+            renderChatHistory(data.path);
+        }
 
         // Update active chat in sidebar
         document.querySelectorAll('.chat-item').forEach(item => {
@@ -257,6 +301,23 @@ async function switchToChat(chatId) {
     }
 }
 
+async function getRunningGeneration(chatId) {
+    const response = await fetch(`/api/chats/${chatId}/generation`);
+    return response.ok ? response.json() : null;
+}
+
+function resumeGeneration(node) {
+    isStreaming = true;
+    autoScrollEnabled = true;
+    userHasScrolled = false;
+
+    document.getElementById('send-btn').style.display = 'none';
+    document.getElementById('stop-btn').style.display = 'block';
+    setStatus('Resuming response...');
+
+    streamChatResponse(node.id, node.role === 'assistant', true);
+}
+
 async function deleteChat(chatId, event) {
     event.stopPropagation();
 
@@ -273,8 +334,7 @@ async function deleteChat(chatId, event) {
         if (result.success) {
             if (currentChatId === chatId) {
                 // If we're deleting the current chat, switch to another or create new
-                const chatListResponse = await fetch('/api/chats');
-                const chats = await chatListResponse.json();
+                const chats = await fetchJSON('/api/chats');
                 const remainingChats = chats.filter(c => c.id !== chatId);
 
                 if (remainingChats.length > 0) {
@@ -290,42 +350,22 @@ async function deleteChat(chatId, event) {
     }
 }
 
-function renderChatHistory(node, path = []) {
+function renderChatHistory(path) {
+    // path holds the nodes from the root to the current node
     const chatContainer = document.getElementById('chat-container');
+    chatContainer.innerHTML = '';
 
-    // Clear container if this is the root call
-    if (path.length === 0) {
-        chatContainer.innerHTML = '';
-    }
-
-    // Add current node to path
-    const currentPath = [...path, node];
-
-    // If this node is on the path to current node, render it
-    if (isOnPathToCurrent(node, currentNodeId)) {
+    path.forEach(node => {
         if (node.role !== 'system') {
             addMessageToUI(node);
         }
-
-        // Find the child that leads to current node and render it
-        const nextChild = node.children.find(child =>
-            isOnPathToCurrent(child, currentNodeId) || child.id === currentNodeId
-        );
-
-        if (nextChild) {
-            renderChatHistory(nextChild, currentPath);
-        }
-    }
+    });
 }
 
-function isOnPathToCurrent(node, targetId) {
-    if (node.id === targetId) return true;
-
-    for (const child of node.children) {
-        if (isOnPathToCurrent(child, targetId)) return true;
-    }
-
-    return false;
+function toolResultHtml(toolName, content) {
+    const resultContent = typeof content === 'object' ? JSON.stringify(content, null, 2) : content;
+    const label = toolName ? `✅ ${toolName} result` : '✅ Result';
+    return `<div class="tool-result"><div class="markdown-content">` + marked.parse(`**${label}**\n\n${resultContent}`) + `</div></div>`;
 }
 
 function addMessageToUI(node) {
@@ -341,21 +381,29 @@ function addMessageToUI(node) {
 
     let contentHtml = '';
 
-    // Handle tool calls
+    // Handle tool calls, each followed by its result
+    const toolResults = node.tool_results || [];
+    const resultsById = {};
+    toolResults.forEach(result => {
+        if (result.tool_call_id) resultsById[result.tool_call_id] = result;
+    });
+    const shownResults = new Set();
     if (node.tool_calls && node.tool_calls.length > 0) {
         node.tool_calls.forEach(toolCall => {
             const args = JSON.parse(toolCall.function.arguments);
             contentHtml += `<div class="tool-call"><div class="markdown-content">` + marked.parse(`**🔨 ${toolCall.function.name}**\n\n\`\`\`json\n${JSON.stringify(args, null, 2)}\n\`\`\``) + `</div></div>`;
+            const result = toolCall.id && resultsById[toolCall.id];
+            if (result) {
+                contentHtml += toolResultHtml(toolCall.function.name, result.content);
+                shownResults.add(result);
+            }
         });
     }
 
-    // Handle tool results
-    if (node.tool_results && node.tool_results.length > 0) {
-        node.tool_results.forEach(result => {
-            const resultContent = typeof result.content === 'object' ? JSON.stringify(result.content, null, 2) : result.content;
-            contentHtml += `<div class="tool-result"><div class="markdown-content">` + marked.parse(`**✅ Result**\n\n${resultContent}`) + `</div></div>`;
-        });
-    }
+    // Results that couldn't be matched to a call by id
+    toolResults.forEach(result => {
+        if (!shownResults.has(result)) contentHtml += toolResultHtml(null, result.content);
+    });
 
     // Handle main content
     if (node.content) {
@@ -553,8 +601,10 @@ async function continueMessage(nodeId) {
     }
 }
 
-async function streamChatResponse(nodeId, isContinuation = false) {
-    const eventSource = new EventSource(`/api/chats/${currentChatId}/stream/${nodeId}`);
+async function streamChatResponse(nodeId, isContinuation = false, resume = false) {
+    // A resume only joins a running generation; it never starts a new one
+    const query = resume ? '?resume=1' : '';
+    const eventSource = new EventSource(`/api/chats/${currentChatId}/stream/${nodeId}${query}`);
     currentEventSource = eventSource;
 
     // Create assistant message element
@@ -592,9 +642,47 @@ async function streamChatResponse(nodeId, isContinuation = false) {
     const contentDiv = assistantDiv.querySelector('.message-content');
     let markdownBuffer = "";
 
+    // Completed markdown blocks are parsed once and appended to stableDiv;
+    // only the trailing (possibly still open) block is re-parsed per update.
+    let stableLength = 0;
+    let stableDiv = null;
+    let tailDiv = null;
+
+    function renderStreamingMarkdown() {
+        if (!stableDiv) {
+            contentDiv.innerHTML = `<div class="markdown-content"><div></div><div></div></div>`;
+            [stableDiv, tailDiv] = contentDiv.firstChild.children;
+        }
+
+        const boundary = findStableBoundary(markdownBuffer, stableLength);
+        if (boundary > stableLength) {
+            const blockDiv = document.createElement('div');
+            blockDiv.innerHTML = marked.parse(markdownBuffer.slice(stableLength, boundary));
+            highlightCodeBlocks(blockDiv);
+            stableDiv.appendChild(blockDiv);
+            stableLength = boundary;
+        }
+
+        tailDiv.innerHTML = marked.parse(markdownBuffer.slice(stableLength));
+        highlightCodeBlocks(tailDiv);
+    }
+
+    function renderFinalMarkdown() {
+        // One full parse so constructs split across blocks render exactly
+        if (!markdownBuffer) return;
+        contentDiv.innerHTML = `<div class="markdown-content">` + marked.parse(markdownBuffer) + `</div>`;
+        highlightCodeBlocks(contentDiv);
+    }
+
     eventSource.onmessage = function (event) {
         const data = JSON.parse(event.data);
 
+        // In passthrough mode the server forwards raw llama-server chunks
+        const events = data.type ? [data] : expandUpstreamChunk(data);
+        events.forEach(handleStreamEvent);
+    };
+
+    function handleStreamEvent(data) {
         switch (data.type) {
             case 'status':
                 setStatus(data.content);
@@ -605,6 +693,7 @@ async function streamChatResponse(nodeId, isContinuation = false) {
                 if (Object.keys(timingsData).length > 0) {
                     const timingsTooltip = `
 Prompt Tokens: ${timingsData.prompt_n}
+Cached Prompt Tokens: ${timingsData.cache_n ?? 0}
 Prompt Time: ${timingsData.prompt_ms.toFixed(2)} ms
 Prompt per Token: ${timingsData.prompt_per_token_ms.toFixed(2)} ms
 Prompt per Second: ${timingsData.prompt_per_second.toFixed(2)} tok/s
@@ -621,11 +710,7 @@ Predicted per Second: ${timingsData.predicted_per_second ? timingsData.predicted
 
             case 'content':
                 markdownBuffer += data.content;
-                contentDiv.innerHTML = `<div class="markdown-content">` + marked.parse(markdownBuffer) + `</div>`;
-                document.querySelectorAll('pre code').forEach((block) => {
-                    delete block.dataset.highlighted;
-                });
-                hljs.highlightAll();
+                renderStreamingMarkdown();
                 scrollToBottom();
                 break;
 
@@ -636,22 +721,35 @@ Predicted per Second: ${timingsData.predicted_per_second ? timingsData.predicted
             case 'tool_call':
                 const toolCallBox = document.createElement('div');
                 toolCallBox.className = 'tool-call';
+                if (data.tool_call_id) toolCallBox.dataset.toolCallId = data.tool_call_id;
                 toolCallBox.innerHTML = `<div class="markdown-content">` + marked.parse(`**🔨 ${data.name}**\n\n\`\`\`json\n${JSON.stringify(data.args, null, 2)}\n\`\`\``) + `</div>`;
                 assistantDiv.insertBefore(toolCallBox, contentDiv); // Insert before contentDiv
                 scrollToBottom();
                 break;
 
             case 'tool_result':
-                const toolResultBox = document.createElement('div');
-                toolResultBox.className = 'tool-result';
-                toolResultBox.innerHTML = `<div class="markdown-content">` + marked.parse(`**✅ Result**\n\n${data.result}`) + `</div>`;
-                assistantDiv.insertBefore(toolResultBox, contentDiv); // Insert before contentDiv
+                // Results arrive as each call finishes, so put each under its call
+                const resultBox = document.createElement('div');
+                resultBox.innerHTML = toolResultHtml(data.name, data.result);
+                const toolResultBox = resultBox.firstChild;
+                const callBox = data.tool_call_id
+                    ? Array.from(assistantDiv.querySelectorAll('.tool-call')).find(box => box.dataset.toolCallId === data.tool_call_id)
+                    : null;
+                if (callBox) {
+                    callBox.after(toolResultBox);
+                } else {
+                    assistantDiv.insertBefore(toolResultBox, contentDiv); // Insert before contentDiv
+                }
                 scrollToBottom();
                 break;
 
             case 'finished':
                 const indicator = assistantDiv.querySelector('.streaming-indicator');
                 if (indicator) indicator.remove();
+                renderFinalMarkdown();
+
+                // Present when the server runs with TRACE_DEBUG
+                if (data.trace) console.debug('Generation timings (ms)', data.trace.breakdown_ms);
 
                 // Add action buttons - include continue since this is now the last message
                 assistantDiv.dataset.nodeId = data.node_id;
@@ -675,16 +773,77 @@ Predicted per Second: ${timingsData.predicted_per_second ? timingsData.predicted
                 stopGeneration();
                 break;
         }
-    };
+    }
 
     eventSource.onerror = function (error) {
+        // While the server keeps generating, EventSource reconnects by itself
+        // and resumes after the last event id it received
+        if (eventSource.readyState === EventSource.CONNECTING) {
+            setStatus('Connection lost, reconnecting...');
+            return;
+        }
         console.error('EventSource error:', error);
         const indicator = assistantDiv.querySelector('.streaming-indicator');
         if (indicator) indicator.remove();
         stopGeneration();
+        if (resume) {
+            // The generation finished before we rejoined; show the saved reply
+            switchToChat(currentChatId);
+        }
     };
 }
 
+function findStableBoundary(text, start) {
+    // Find the end of the last complete block after start: a blank line
+    // outside any code fence that is followed by an unindented line.
+    // start must itself be such a boundary (or 0).
+    let boundary = start;
+    let inFence = false;
+    let blankAt = -1;
+    let pos = start;
+
+    while (true) {
+        const end = text.indexOf('\n', pos);
+        if (end === -1) break; // the last line may still be growing
+        const line = text.slice(pos, end);
+
+        if (/^ {0,3}(```|~~~)/.test(line)) {
+            inFence = !inFence;
+            blankAt = -1;
+        } else if (!inFence && line.trim() === '') {
+            blankAt = pos;
+        } else if (blankAt !== -1) {
+            // Indented lines and list items may continue the previous block
+            if (!/^(\s|[-*+] |\d+[.)] )/.test(line)) boundary = pos;
+            blankAt = -1;
+        }
+        pos = end + 1;
+    }
+    return boundary;
+}
+
+function highlightCodeBlocks(container) {
+    container.querySelectorAll('pre code').forEach((block) => {
+        hljs.highlightElement(block);
+    });
+}
+
+function expandUpstreamChunk(chunk) {
+    // Convert an OpenAI-style streaming chunk into the app's typed events
+    const events = [];
+    if (chunk.timings) {
+        events.push({ type: 'timings', timings: chunk.timings });
+    }
+    const delta = (chunk.choices && chunk.choices[0] && chunk.choices[0].delta) || {};
+    if (delta.content) {
+        events.push({ type: 'content', content: delta.content });
+    }
+    if (delta.reasoning_content) {
+        events.push({ type: 'reasoning_content', content: delta.reasoning_content });
+    }
+    return events;
+}
+
 function editMessage(nodeId, role) {
     editingNodeId = nodeId;
     editingNodeRole = role;
@@ -0,0 +1,666 @@
+import copy
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# --------------------
+# SQLITE CHAT STORE
+# --------------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    current_node_id TEXT NOT NULL,
+    files TEXT NOT NULL DEFAULT '{}',
+    rev INTEGER NOT NULL DEFAULT 0,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+    parent_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_chat ON nodes(chat_id, seq);
+CREATE TABLE IF NOT EXISTS files (
+    uuid TEXT PRIMARY KEY,
+    info TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deleted_chats (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sequence (
+    value INTEGER NOT NULL
+);
+"""
+# Created once the seq columns exist, which older databases gain on open
+SEQ_INDEXES = """
+CREATE INDEX IF NOT EXISTS chats_seq ON chats(seq);
+CREATE INDEX IF NOT EXISTS files_seq ON files(seq);
+CREATE INDEX IF NOT EXISTS deleted_chats_seq ON deleted_chats(seq);
+"""
+
+
+class ChatStore:
+    """SQLite-backed storage where every write touches only the changed rows.
+
+    Chats, nodes, files and settings are stored as separate rows, so adding a
+    message writes a single node row plus the chat's metadata row. The
+    database runs in WAL mode; each call commits atomically and an
+    interrupted write is rolled back by SQLite on the next open.
+
+    Several processes may share the file. Every write to a chat bumps its
+    rev, and changed_elsewhere() tells a process when another one has
+    committed. Each write transaction also takes the next number of a
+    store-wide sequence and stamps the chat, file and deletion rows it
+    touches with it, so changes_since() can fetch just what changed.
+    Forked children open their own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connect()
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(chats)")]
+        if "rev" not in columns:
+            self._conn.execute(
+                "ALTER TABLE chats ADD COLUMN rev INTEGER NOT NULL DEFAULT 0"
+            )
+        for table in ("chats", "files"):
+            columns = [
+                row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")
+            ]
+            if "seq" not in columns:
+                self._conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"
+                )
+        self._conn.executescript(SEQ_INDEXES)
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM sequence").fetchone() is None:
+                conn.execute("INSERT INTO sequence (value) VALUES (0)")
+        self._data_version = self._read_data_version()
+        os.register_at_fork(after_in_child=self._connect)
+
+    def _connect(self):
+        # SQLite connections must not be used across fork()
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of writes as one atomic transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._tx_seq = None
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _seq(self, conn):
+        """Get the current transaction's sequence number, taking it on first use.
+
+        Writers are serialized by BEGIN IMMEDIATE, so numbers become visible
+        to readers in increasing order.
+        """
+        if self._tx_seq is None:
+            self._tx_seq = conn.execute(
+                "UPDATE sequence SET value = value + 1 RETURNING value"
+            ).fetchone()[0]
+        return self._tx_seq
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def changed_elsewhere(self):
+        """Check whether another connection has committed since the last call."""
+        with self._lock:
+            data_version = self._read_data_version()
+            changed = data_version != self._data_version
+            self._data_version = data_version
+        return changed
+
+    def _read_data_version(self):
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    # Writes
+
+    def save_chat(self, chat, nodes=()):
+        """Upsert a chat's metadata row and the given node records.
+
+        Returns the chat's new rev.
+        """
+        with self.transaction() as conn:
+            rev = self._write_chat(conn, chat)
+            for node in nodes:
+                self._write_node(conn, chat["id"], node)
+        return rev
+
+    def delete_chat(self, chat_id):
+        with self.transaction() as conn:
+            self._delete_chat(conn, chat_id)
+
+    def save_file(self, file_uuid, info):
+        with self.transaction() as conn:
+            self._write_file(conn, file_uuid, info)
+
+    def save_setting(self, key, value):
+        with self.transaction() as conn:
+            self._write_setting(conn, key, value)
+
+    def write_batch(self, chats, nodes, files, settings):
+        """Apply a batch of queued writes in one transaction.
+
+        chats maps chat ids to metadata records, or to None to delete the
+        chat; nodes maps chat ids to lists of node records.
+        """
+        with self.transaction() as conn:
+            for chat_id, chat in chats.items():
+                if chat is None:
+                    self._delete_chat(conn, chat_id)
+                else:
+                    self._write_chat(conn, chat)
+            for chat_id, records in nodes.items():
+                for node in records:
+                    self._write_node(conn, chat_id, node)
+            for file_uuid, info in files.items():
+                self._write_file(conn, file_uuid, info)
+            for key, value in settings.items():
+                self._write_setting(conn, key, value)
+
+    def _write_chat(self, conn, chat):
+        return conn.execute(
+            "INSERT INTO chats "
+            "(id, title, created_at, updated_at, current_node_id, files, rev, seq) "
+            "VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT(id) DO UPDATE SET title = excluded.title, "
+            "updated_at = excluded.updated_at, "
+            "current_node_id = excluded.current_node_id, files = excluded.files, "
+            "rev = chats.rev + 1, seq = excluded.seq RETURNING rev",
+            (
+                chat["id"],
+                chat["title"],
+                chat["created_at"],
+                chat["updated_at"],
+                chat["current_node_id"],
+                json.dumps(chat.get("files", {})),
+                self._seq(conn),
+            ),
+        ).fetchone()[0]
+
+    def _delete_chat(self, conn, chat_id):
+        conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+        conn.execute(
+            "INSERT OR REPLACE INTO deleted_chats (id, seq) VALUES (?, ?)",
+            (chat_id, self._seq(conn)),
+        )
+
+    def _write_node(self, conn, chat_id, node):
+        conn.execute(
+            "INSERT INTO nodes (id, chat_id, parent_id, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+            (node["id"], chat_id, node.get("parent_id"), json.dumps(node)),
+        )
+
+    def _write_file(self, conn, file_uuid, info):
+        conn.execute(
+            "INSERT INTO files (uuid, info, seq) VALUES (?, ?, ?) "
+            "ON CONFLICT(uuid) DO UPDATE SET info = excluded.info, seq = excluded.seq",
+            (file_uuid, json.dumps(info), self._seq(conn)),
+        )
+
+    def _write_setting(self, conn, key, value):
+        conn.execute(
+            "INSERT INTO settings (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value)),
+        )
+
+    # Reads
+
+    def load_chat_index(self):
+        """Load metadata records for every chat without touching their nodes."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, title, created_at, updated_at, rev FROM chats"
+            ).fetchall()
+        return [
+            {
+                "id": chat_id,
+                "title": title,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "rev": rev,
+            }
+            for chat_id, title, created_at, updated_at, rev in rows
+        ]
+
+    def current_seq(self):
+        """Get the sequence number of the last committed write."""
+        with self._lock:
+            return self._conn.execute("SELECT value FROM sequence").fetchone()[0]
+
+    def changes_since(self, seq):
+        """Get what was written after sequence number seq.
+
+        Returns (chat index records, deleted chat ids, file records by uuid,
+        the sequence number these changes run up to). Pass that number to
+        the next call.
+        """
+        with self._lock:
+            # One read transaction, so the rows and the number agree
+            self._conn.execute("BEGIN")
+            try:
+                latest = self._conn.execute("SELECT value FROM sequence").fetchone()[0]
+                chat_rows = self._conn.execute(
+                    "SELECT id, title, created_at, updated_at, rev FROM chats "
+                    "WHERE seq > ?",
+                    (seq,),
+                ).fetchall()
+                deleted_rows = self._conn.execute(
+                    "SELECT id FROM deleted_chats WHERE seq > ?", (seq,)
+                ).fetchall()
+                file_rows = self._conn.execute(
+                    "SELECT uuid, info FROM files WHERE seq > ?", (seq,)
+                ).fetchall()
+            finally:
+                self._conn.execute("COMMIT")
+        chats = [
+            {
+                "id": chat_id,
+                "title": title,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "rev": rev,
+            }
+            for chat_id, title, created_at, updated_at, rev in chat_rows
+        ]
+        files = {file_uuid: json.loads(info) for file_uuid, info in file_rows}
+        return chats, [chat_id for (chat_id,) in deleted_rows], files, latest
+
+    def load_chat(self, chat_id, chat=None, nodes=()):
+        """Load a single chat in the nested ``Chat.to_dict`` format.
+
+        chat (a metadata record) and nodes (node records), if given, are
+        writes not committed yet; they are applied over the stored rows.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, title, created_at, updated_at, current_node_id, files, "
+                "rev FROM chats WHERE id = ?",
+                (chat_id,),
+            ).fetchone()
+            if row is None and chat is None:
+                return None
+            node_rows = self._conn.execute(
+                "SELECT data FROM nodes WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            ).fetchall()
+        records = [json.loads(data) for (data,) in node_rows]
+        if nodes:
+            # Changed nodes keep their place; new ones come after the stored ones
+            index = {record["id"]: i for i, record in enumerate(records)}
+            for node in nodes:
+                if node["id"] in index:
+                    records[index[node["id"]]] = node
+                else:
+                    records.append(node)
+        root = build_tree(records)
+        if root is None:
+            return None
+        if chat is not None:
+            row = (
+                chat["id"],
+                chat["title"],
+                chat["created_at"],
+                chat["updated_at"],
+                chat["current_node_id"],
+                json.dumps(chat.get("files", {})),
+                row[6] if row else 0,
+            )
+        return chat_from_row(row, root)
+
+    def load_files(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT uuid, info FROM files").fetchall()
+        return {file_uuid: json.loads(info) for file_uuid, info in rows}
+
+    def load_setting(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM settings WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def is_empty(self):
+        with self._lock:
+            return (
+                self._conn.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None
+                and self._conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+                and self._conn.execute("SELECT 1 FROM settings LIMIT 1").fetchone()
+                is None
+            )
+
+    # Migration
+
+    def migrate_from_pickle(self, pickle_path):
+        """Import a legacy ``chats.pkl`` file into an empty store.
+
+        The import runs in a single transaction and the pickle is renamed to
+        ``<name>.migrated`` afterwards, so a crash mid-import leaves the
+        original file in place to retry from. Returns True if data was
+        imported.
+        """
+        if not os.path.exists(pickle_path) or not self.is_empty():
+            return False
+
+        with open(pickle_path, "rb") as f:
+            data = pickle.load(f)
+
+        with self.transaction() as conn:
+            for chat_id, chat in data.get("chats", {}).items():
+                tree = chat["tree"]
+                self._write_chat(
+                    conn,
+                    {
+                        "id": chat_id,
+                        "title": chat["title"],
+                        "created_at": chat["created_at"],
+                        "updated_at": chat["updated_at"],
+                        "current_node_id": tree["current_node_id"],
+                        "files": tree.get("files", {}),
+                    },
+                )
+                for node in flatten_tree(tree["root"]):
+                    self._write_node(conn, chat_id, node)
+            for file_uuid, info in data.get("global_files", {}).items():
+                conn.execute(
+                    "INSERT INTO files (uuid, info) VALUES (?, ?)",
+                    (file_uuid, json.dumps(info)),
+                )
+            if "enabled_tools" in data:
+                conn.execute(
+                    "INSERT INTO settings (key, value) VALUES (?, ?)",
+                    ("enabled_tools", json.dumps(data["enabled_tools"])),
+                )
+
+        os.replace(pickle_path, pickle_path + ".migrated")
+        return True
+
+
+# --------------------
+# WRITE-BEHIND QUEUE
+# --------------------
+class WriteBehind:
+    """Queues ChatStore writes and commits them from a background thread.
+
+    Writes arriving within delay seconds of the first queued one are merged,
+    so a chat saved several times during a turn costs one transaction, and
+    request handlers never wait on disk. At most delay seconds of changes
+    (plus the write in progress) are lost if the process dies; close()
+    flushes everything. A delay of 0 writes through synchronously.
+
+    Records are copied when queued, so callers may keep changing theirs.
+    Saves of a deleted chat are dropped until its delete is written. Reads
+    of a chat go through load_chat, which sees its queued writes without
+    waiting for them. on_flush, if set, is called with the seconds each
+    committed batch took to write.
+    """
+
+    def __init__(self, store, delay):
+        self.store = store
+        self.delay = delay
+        self.saves = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.on_flush = None
+        self._chats = {}  # chat id -> chat record, or None to delete
+        self._nodes = {}  # chat id -> {node id: node record}
+        self._files = {}
+        self._settings = {}
+        # Ids of chats deleted but not yet written, whose saves are dropped
+        self._deleted = set()
+        self._writing = ({}, {})  # chats and nodes of the batch being written
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def save_chat(self, chat, nodes=()):
+        chat = copy.deepcopy(chat)
+        nodes = copy.deepcopy(list(nodes))
+        with self._cond:
+            if chat["id"] in self._deleted:
+                return
+            self._chats[chat["id"]] = chat
+            pending = self._nodes.setdefault(chat["id"], {})
+            for node in nodes:
+                pending[node["id"]] = node
+            self.saves += 1
+        self._queued()
+
+    def delete_chat(self, chat_id):
+        with self._cond:
+            self._deleted.add(chat_id)
+            self._chats[chat_id] = None
+            self._nodes.pop(chat_id, None)
+        self._queued()
+
+    def save_file(self, file_uuid, info):
+        info = copy.deepcopy(info)
+        with self._cond:
+            self._files[file_uuid] = info
+        self._queued()
+
+    def save_setting(self, key, value):
+        value = copy.deepcopy(value)
+        with self._cond:
+            self._settings[key] = value
+        self._queued()
+
+    def load_chat(self, chat_id):
+        """Load a chat from the store with its unwritten changes applied.
+
+        Changes to the chat must not be queued meanwhile.
+        """
+        with self._cond:
+            if chat_id in self._deleted:
+                return None
+            chat, nodes, pending = None, {}, False
+            # The batch being written is older than what is queued
+            for chats, node_batches in (self._writing, (self._chats, self._nodes)):
+                if chat_id in chats:
+                    chat, pending = chats[chat_id], True
+                nodes.update(node_batches.get(chat_id, {}))
+            chat, nodes = copy.deepcopy(chat), copy.deepcopy(list(nodes.values()))
+        if not (pending or nodes):
+            return self.store.load_chat(chat_id)
+        return self.store.load_chat(chat_id, chat, nodes)
+
+    def flush(self):
+        """Write everything queued so far, in one transaction."""
+        with self._flush_lock:
+            with self._cond:
+                chats, nodes = self._chats, self._nodes
+                files, settings = self._files, self._settings
+                self._chats, self._nodes, self._files, self._settings = {}, {}, {}, {}
+                self._writing = (chats, nodes)
+            if not (chats or files or settings):
+                return
+
+            started = time.perf_counter()
+            try:
+                self.store.write_batch(
+                    chats,
+                    {
+                        chat_id: list(records.values())
+                        for chat_id, records in nodes.items()
+                    },
+                    files,
+                    settings,
+                )
+            except Exception:
+                self._requeue(chats, nodes, files, settings)
+                self.errors += 1
+                raise
+            finally:
+                with self._cond:
+                    self._writing = ({}, {})
+            with self._cond:
+                # Written deletes no longer need to drop saves; save_chat
+                # skips chats that are gone
+                self._deleted.difference_update(
+                    chat_id for chat_id, chat in chats.items() if chat is None
+                )
+            seconds = time.perf_counter() - started
+            self.flushes += 1
+            self.last_flush_ms = seconds * 1000
+            if self.on_flush is not None:
+                self.on_flush(seconds)
+
+    def close(self):
+        """Stop the writer thread and flush what is left."""
+        self._stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._chats) + len(self._files) + len(self._settings)
+        return {
+            "delay": self.delay,
+            "pending": pending,
+            "saves": self.saves,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+    def _queued(self):
+        if not self.delay:
+            self.flush()
+            return
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            with self._cond:
+                while not (self._chats or self._files or self._settings):
+                    if self._stopping.is_set():
+                        return
+                    self._cond.wait()
+            # Let more writes pile up before committing them together
+            self._stopping.wait(self.delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing chats, retrying: {e}")
+
+    def _requeue(self, chats, nodes, files, settings):
+        # Put a failed batch back without overwriting anything newer
+        with self._cond:
+            for chat_id, chat in chats.items():
+                self._chats.setdefault(chat_id, chat)
+            for chat_id, records in nodes.items():
+                if self._chats.get(chat_id) is None:
+                    continue
+                pending = self._nodes.setdefault(chat_id, {})
+                for node_id, node in records.items():
+                    pending.setdefault(node_id, node)
+            for file_uuid, info in files.items():
+                self._files.setdefault(file_uuid, info)
+            for key, value in settings.items():
+                self._settings.setdefault(key, value)
+
+
+# --------------------
+# TREE HELPERS
+# --------------------
+def flatten_tree(root):
+    """Yield node records (without children) from a nested node dict."""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        children = node.get("children", [])
+        record = {key: value for key, value in node.items() if key != "children"}
+        yield record
+        stack.extend(reversed(children))
+
+
+def build_tree(records):
+    """Rebuild a nested node dict from records ordered by insertion.
+
+    A node whose parent is missing is logged and attached under the root
+    rather than dropped, so its subtree stays reachable.
+    """
+    by_id = {}
+    for record in records:
+        node = dict(record, children=[])
+        by_id[node["id"]] = node
+    root = None
+    orphans = []
+    for record in records:
+        node = by_id[record["id"]]
+        parent_id = record.get("parent_id")
+        if parent_id is None and root is None:
+            root = node
+        elif parent_id in by_id:
+            by_id[parent_id]["children"].append(node)
+        else:
+            orphans.append(node)
+
+    if root is None and orphans:
+        root = orphans.pop(0)
+    if orphans:
+        ids = ", ".join(node["id"] for node in orphans)
+        print(f"Attaching nodes with missing parents under the root: {ids}")
+        for node in orphans:
+            node["parent_id"] = root["id"]
+            root["children"].append(node)
+    return root
+
+
+def chat_from_row(row, root):
+    chat_id, title, created_at, updated_at, current_node_id, files, rev = row
+    return {
+        "id": chat_id,
+        "title": title,
+        "created_at": created_at,
+        "updated_at": updated_at,
+        "rev": rev,
+        "tree": {
+            "root": root,
+            "current_node_id": current_node_id,
+            "files": json.loads(files),
+        },
+    }
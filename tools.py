@@ -1,6 +1,161 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from googlesearch import search, SearchResult
 from bs4 import BeautifulSoup
+from dotenv import load_dotenv
 import requests
+from cache import LRUCache
+
+load_dotenv()
+
+TOOL_CACHE_DB = os.getenv("TOOL_CACHE_DB", "tool_cache.db")
+TOOL_CACHE_BYTES = int(os.getenv("TOOL_CACHE_BYTES", 16 * 1024 * 1024))
+# Seconds a result stays fresh, per tool
+TOOL_CACHE_TTLS = {
+    "web_search": float(os.getenv("WEB_SEARCH_CACHE_TTL", 60 * 60)),
+    "read_url": float(os.getenv("READ_URL_CACHE_TTL", 24 * 60 * 60)),
+}
+# Expired entries are kept this long so they can still be revalidated
+TOOL_CACHE_RETENTION = 7 * 24 * 60 * 60
+
+
+# --------------------
+# RESULT CACHE
+# --------------------
+class ToolResultCache:
+    """Tool results cached in a memory LRU backed by a SQLite file.
+
+    Entries are dicts with the result "value", an "expires_at" timestamp and
+    the "etag"/"last_modified" validators of fetched pages. Expired entries
+    are still returned so callers can revalidate them.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.memory = LRUCache(max_bytes, sizeof=lambda entry: len(entry["value"]))
+        self.counts = {}  # tool -> {"hits", "misses", "revalidated"}
+        self.path = path
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # SQLite connections must not be used across fork()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        """Get the connection, opening the database on first use.
+
+        Call with the lock held. Importing tools doesn't create the file.
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, "
+                    "entry TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute(
+                    "DELETE FROM results WHERE expires_at < ?",
+                    (time.time() - TOOL_CACHE_RETENTION,),
+                )
+            self._conn = conn
+        return self._conn
+
+    def get(self, tool, key):
+        cache_key = f"{tool}:{key}"
+        entry = self.memory.get(cache_key)
+        if entry is None:
+            with self._lock:
+                row = (
+                    self._db()
+                    .execute("SELECT entry FROM results WHERE key = ?", (cache_key,))
+                    .fetchone()
+                )
+            if row:
+                entry = json.loads(row[0])
+                self.memory.put(cache_key, entry)
+        return entry
+
+    def put(self, tool, key, value, ttl, etag=None, last_modified=None):
+        cache_key = f"{tool}:{key}"
+        entry = {
+            "value": value,
+            "expires_at": time.time() + ttl,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        self.memory.put(cache_key, entry)
+        with self._lock:
+            with self._db() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results (key, entry, expires_at) "
+                    "VALUES (?, ?, ?)",
+                    (cache_key, json.dumps(entry), entry["expires_at"]),
+                )
+
+    def record(self, tool, outcome):
+        """Count a lookup outcome: "hits", "misses" or "revalidated"."""
+        with self._lock:
+            counts = self.counts.setdefault(
+                tool, {"hits": 0, "misses": 0, "revalidated": 0}
+            )
+            counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            tools = {}
+            for tool, counts in self.counts.items():
+                lookups = sum(counts.values())
+                served = counts["hits"] + counts["revalidated"]
+                tools[tool] = dict(counts, hit_rate=served / lookups)
+        return {"tools": tools, "memory": self.memory.stats()}
+
+
+tool_cache = ToolResultCache(TOOL_CACHE_DB, TOOL_CACHE_BYTES)
+
+
+def normalize_url(url):
+    """Normalize a URL so equivalent spellings share a cache entry."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, parts.port) in (("http", 80), ("https", 443)):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def http_cache_ttl(headers, default):
+    """Get how long a response may be cached from its HTTP headers.
+
+    Returns None if the response must not be stored.
+    """
+    cache_control = headers.get("Cache-Control", "").lower()
+    directives = [d.strip() for d in cache_control.split(",")]
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return max(0, int(directive[8:]))
+            except ValueError:
+                break
+    if "Expires" in headers:
+        try:
+            expires = parsedate_to_datetime(headers["Expires"]).timestamp()
+            return max(0, expires - time.time())
+        except (TypeError, ValueError):
+            return 0
+    return default
 
 
 # --------------------
@@ -21,6 +176,20 @@ def run_calculator(num1, num2, operation):
 
 def run_web_search(query, num_results=5):
     """Perform a Google search and return a list of results in Markdown format."""
+    key = json.dumps([" ".join(query.lower().split()), num_results])
+    entry = tool_cache.get("web_search", key)
+    if entry and entry["expires_at"] > time.time():
+        tool_cache.record("web_search", "hits")
+        return entry["value"]
+    tool_cache.record("web_search", "misses")
+
+    result_md = search_markdown(query, num_results)
+    tool_cache.put("web_search", key, result_md, TOOL_CACHE_TTLS["web_search"])
+    return result_md
+
+
+def search_markdown(query, num_results):
+    """Run a Google search and format the results as Markdown."""
     print(f"Performing Google search for: {query}")
     result_md = ""
 
@@ -38,22 +207,132 @@ def run_web_search(query, num_results=5):
 
 def run_read_url(url):
     """Fetch the contents of a URL and return as plain text."""
+    key, entry, headers, result = lookup_read_url(url)
+    if result is not None:
+        return result
+
     print(f"Fetching URL: {url}")
     try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
+        resp = requests.get(url, timeout=10, headers=headers)
+        if not (resp.status_code == 304 and entry):
+            resp.raise_for_status()
     except requests.RequestException as e:
         return f"Error fetching URL: {e}"
+    return store_read_url(key, entry, resp.status_code, resp.headers, resp.text)
+
+
+async def arun_read_url(url):
+    """Like run_read_url, but fetches with httpx without blocking a thread."""
+    import httpx
+
+    key, entry, headers, result = lookup_read_url(url)
+    if result is not None:
+        return result
 
+    print(f"Fetching URL: {url}")
     try:
-        soup = BeautifulSoup(resp.text, "html.parser")
+        resp = await async_http_client().get(url, timeout=10, headers=headers)
+        if not (resp.status_code == 304 and entry):
+            resp.raise_for_status()
+    except httpx.HTTPError as e:
+        return f"Error fetching URL: {e}"
+    # Parsing a large page takes a while; keep it off the event loop
+    return await asyncio.to_thread(
+        store_read_url, key, entry, resp.status_code, resp.headers, resp.text
+    )
+
+
+def lookup_read_url(url):
+    """Check the cache before fetching a URL for read_url.
+
+    Returns (cache key, cached entry, request headers, result). result is
+    set when no fetch is needed (a fresh cache hit or a bad URL); headers
+    revalidate a stale entry instead of refetching it when possible.
+    """
+    try:
+        key = normalize_url(url)
+    except ValueError as e:
+        return None, None, {}, f"Error fetching URL: {e}"
+    entry = tool_cache.get("read_url", key)
+    if entry and entry["expires_at"] > time.time():
+        tool_cache.record("read_url", "hits")
+        return key, entry, {}, entry["value"]
+
+    headers = {}
+    if entry and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return key, entry, headers, None
+
+
+def store_read_url(key, entry, status_code, headers, text):
+    """Turn a successful read_url fetch into plain text and cache it.
+
+    A 304 answers from the revalidated cache entry.
+    """
+    if status_code == 304 and entry:
+        ttl = http_cache_ttl(headers, TOOL_CACHE_TTLS["read_url"])
+        if ttl is not None:
+            tool_cache.put(
+                "read_url",
+                key,
+                entry["value"],
+                ttl,
+                headers.get("ETag", entry["etag"]),
+                headers.get("Last-Modified", entry["last_modified"]),
+            )
+        tool_cache.record("read_url", "revalidated")
+        return entry["value"]
+    tool_cache.record("read_url", "misses")
+
+    try:
+        soup = BeautifulSoup(text, "html.parser")
         for element in soup(["script", "style", "noscript"]):
             element.decompose()
         text = soup.get_text(separator="\n", strip=True)
-        return text
     except Exception as e:
         return f"Error parsing HTML: {e}"
 
+    ttl = http_cache_ttl(headers, TOOL_CACHE_TTLS["read_url"])
+    if ttl is not None:
+        tool_cache.put(
+            "read_url",
+            key,
+            text,
+            ttl,
+            headers.get("ETag"),
+            headers.get("Last-Modified"),
+        )
+    return text
+
+
+# (event loop, httpx.AsyncClient) used by async tool handlers
+_async_client = None
+
+
+def async_http_client():
+    """Get the httpx client for the running event loop.
+
+    httpx is only needed by the ASGI entry point, so it is imported here.
+    """
+    global _async_client
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client[0] is not loop:
+        import httpx
+
+        _async_client = (loop, httpx.AsyncClient(follow_redirects=True))
+    return _async_client[1]
+
+
+async def close_async_http_client():
+    """Close the running event loop's httpx client, if it has one."""
+    global _async_client
+    if _async_client is not None and _async_client[0] is asyncio.get_running_loop():
+        client = _async_client[1]
+        _async_client = None
+        await client.aclose()
+
 
 TOOLS = {
     "calculator": {
@@ -79,6 +358,7 @@ TOOLS = {
         "handler": lambda args: str(
             run_calculator(args["num1"], args["num2"], args["operation"])
         ),
+        "timeout": 5,
     },
     "web_search": {
         "schema": {
@@ -103,6 +383,7 @@ TOOLS = {
         "handler": lambda args: run_web_search(
             args["query"], args.get("num_results", 5)
         ),
+        "timeout": 30,
     },
     "read_url": {
         "schema": {
@@ -123,5 +404,7 @@ TOOLS = {
             },
         },
         "handler": lambda args: run_read_url(args["url"]),
+        "async_handler": lambda args: arun_read_url(args["url"]),
+        "timeout": 20,
     },
 }
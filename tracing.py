@@ -0,0 +1,214 @@
+import contextvars
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+import os
+
+# Finished traces kept for /api/traces; 0 (the default) keeps none
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", 0))
+# Attach each generation's timing breakdown to its "finished" event. Spans
+# are recorded when this is set or TRACE_KEEP is above 0; otherwise tracing
+# is off.
+TRACE_DEBUG = os.getenv("TRACE_DEBUG", "").lower() in ("1", "true", "yes")
+
+# (trace, id of the innermost open span) for the code running now
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+# --------------------
+# TRACES
+# --------------------
+class Span:
+    def __init__(self, span_id, parent_id, name, start, tags):
+        self.id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = None
+        self.tags = tags
+        self.thread = threading.get_ident()
+
+
+class Trace:
+    """Timed, nested spans of one request, e.g. one generation.
+
+    Spans may be added from any thread; run work in another thread with a
+    copy of the current context (contextvars.copy_context) to nest its
+    spans under the caller's.
+    """
+
+    def __init__(self, name, tags):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.tags = tags
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def open(self, name, parent_id, tags, start=None):
+        span = Span(
+            next(self._ids),
+            parent_id,
+            name,
+            time.perf_counter() if start is None else start,
+            tags,
+        )
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def finished_spans(self):
+        with self._lock:
+            return [span for span in self.spans if span.end is not None]
+
+    def breakdown(self):
+        """Milliseconds spent per span name, plus the trace's total so far.
+
+        Spans of the same name are added up, so concurrent spans (e.g. tool
+        calls) can add up to more than the total.
+        """
+        totals = {}
+        for span in self.finished_spans():
+            if span.parent_id is not None:
+                ms = (span.end - span.start) * 1000
+                totals[span.name] = totals.get(span.name, 0.0) + ms
+        root = self.spans[0]
+        end = root.end if root.end is not None else time.perf_counter()
+        totals["total"] = (end - root.start) * 1000
+        return {name: round(ms, 3) for name, ms in totals.items()}
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "tags": self.tags,
+            "started_at": self.started_at.isoformat(),
+            "breakdown_ms": self.breakdown(),
+        }
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "tags": self.tags,
+            "started_at": self.started_at.isoformat(),
+            "spans": [
+                {
+                    "id": span.id,
+                    "parent_id": span.parent_id,
+                    "name": span.name,
+                    "start_ms": round((span.start - self.start) * 1000, 3),
+                    "duration_ms": round((span.end - span.start) * 1000, 3),
+                    "tags": span.tags,
+                }
+                for span in self.finished_spans()
+            ],
+        }
+
+    def to_chrome(self):
+        """The trace in Chrome's trace event format (chrome://tracing, Perfetto)."""
+        events = [
+            {
+                "name": span.name,
+                "cat": self.name,
+                "ph": "X",
+                "ts": round((span.start - self.start) * 1e6),
+                "dur": round((span.end - span.start) * 1e6),
+                "pid": 1,
+                "tid": span.thread,
+                "args": dict(span.tags, trace_id=self.id),
+            }
+            for span in self.finished_spans()
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+class TraceStore:
+    """The most recent finished traces, by id."""
+
+    def __init__(self, keep):
+        self.keep = keep
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self._traces[trace.id] = trace
+            while len(self._traces) > self.keep:
+                self._traces.popitem(last=False)
+
+    def get(self, trace_id):
+        with self._lock:
+            return self._traces.get(trace_id)
+
+    def recent(self):
+        with self._lock:
+            return list(reversed(self._traces.values()))
+
+
+traces = TraceStore(TRACE_KEEP)
+
+
+# --------------------
+# SPANS
+# --------------------
+@contextmanager
+def trace(name, **tags):
+    """Start a new trace for the code in the with block and yield it.
+
+    Yields None when tracing is off. The finished trace is only stored for
+    /api/traces when TRACE_KEEP is above 0.
+    """
+    if not TRACE_KEEP and not TRACE_DEBUG:
+        yield None
+        return
+    current = Trace(name, tags)
+    root = current.open(name, None, tags)
+    token = _current.set((current, root.id))
+    try:
+        yield current
+    finally:
+        root.end = time.perf_counter()
+        _current.reset(token)
+        if TRACE_KEEP:
+            traces.add(current)
+
+
+@contextmanager
+def span(name, **tags):
+    """Time the with block as a span nested in the current one, if any."""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    active, parent_id = current
+    opened = active.open(name, parent_id, tags)
+    token = _current.set((active, opened.id))
+    try:
+        yield
+    finally:
+        opened.end = time.perf_counter()
+        _current.reset(token)
+
+
+def current_trace():
+    """The trace the running code belongs to, or None."""
+    current = _current.get()
+    return current[0] if current is not None else None
+
+
+def record_span(name, start, end, **tags):
+    """Add a span that has already finished (times from time.perf_counter)."""
+    current = _current.get()
+    if current is not None:
+        active, parent_id = current
+        active.open(name, parent_id, tags, start).end = end
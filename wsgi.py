@@ -0,0 +1,9 @@
+"""WSGI entry point, e.g. ``gunicorn -w 4 -k gthread --threads 32 wsgi:app``.
+
+Set APP_WORKERS to the number of worker processes so they share CHATS_DB
+safely.
+"""
+
+from app import app, load_chats
+
+load_chats()